@@ -0,0 +1,69 @@
+"""
+Benchmark of the HTML-to-text backends of crawl_website.py (BeautifulSoup's html.parser, lxml,
+selectolax) over a local corpus of saved pages, with their agreement with BeautifulSoup.
+
+Usage: python3 benchmark_html.py <corpus dir> [repeats]
+where <corpus dir> holds saved pages (*.html, *.htm), decoded with their declared charset.
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+
+from crawl_website import _TEXT_EXTRACTORS, clean_html, decode_html
+
+
+def load_corpus(corpus_dir):
+    pages = []
+    for name in sorted(os.listdir(corpus_dir)):
+        if name.lower().endswith((".html", ".htm")):
+            with open(os.path.join(corpus_dir, name), "rb") as reader:
+                pages.append(decode_html(reader.read()))
+    return pages
+
+
+def available_backends():
+    backends = []
+    for name in _TEXT_EXTRACTORS:
+        try:
+            clean_html("<p>x</p>", backend=name)
+            backends.append(name)
+        except ImportError:
+            print(f"{name}: not installed, skipped")
+    return backends
+
+
+def time_backend(backend, pages, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        # clean_html reports every page it trims.
+        with contextlib.redirect_stdout(io.StringIO()):
+            texts = [clean_html(html, backend=backend) for html in pages]
+        best = min(best, time.perf_counter() - start)
+    return best, texts
+
+
+def main(corpus_dir, repeats=3):
+    pages = load_corpus(corpus_dir)
+    if not pages:
+        print(f"No *.html pages in {corpus_dir}")
+        sys.exit(1)
+    print(f"{len(pages)} pages, {sum(len(html) for html in pages) / 1e6:.1f}M characters of HTML")
+
+    results = {backend: time_backend(backend, pages, repeats) for backend in available_backends()}
+    reference_time, reference = results["bs4"]
+    print(f"{'backend':<12}{'ms/page':>10}{'speedup':>10}{'same text':>12}{'same words':>12}")
+    for backend, (elapsed, texts) in results.items():
+        same_text = sum(a == b for a, b in zip(texts, reference)) / len(pages)
+        same_words = sum(a.split() == b.split() for a, b in zip(texts, reference)) / len(pages)
+        print(f"{backend:<12}{1000 * elapsed / len(pages):>10.2f}{reference_time / elapsed:>9.2f}x"
+              f"{same_text:>12.3f}{same_words:>12.3f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python3 benchmark_html.py <corpus dir> [repeats]")
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else 3)
@@ -0,0 +1,68 @@
+"""
+Parity check and microbenchmark of `normalize_text` in crawl_website.py against
+the one-pass-per-rule reference it replaced, over the extracted text of a local page corpus
+and over random strings made of the characters the rules treat specially.
+
+Usage: python3 benchmark_normalize.py <corpus dir> [repeats]
+where <corpus dir> holds saved pages (*.html, *.htm) or extracted texts (*.txt).
+"""
+import os
+import random
+import sys
+import time
+
+from crawl_website import (NORMALIZE_SPECIAL_CHARS, _normalize_text_by_passes, decode_html, extract_text,
+                           normalize_text)
+
+
+def load_texts(corpus_dir):
+    texts = []
+    for name in sorted(os.listdir(corpus_dir)):
+        path = os.path.join(corpus_dir, name)
+        if name.lower().endswith((".html", ".htm")):
+            with open(path, "rb") as reader:
+                texts.append(extract_text(decode_html(reader.read())))
+        elif name.endswith(".txt"):
+            with open(path, "r", encoding="utf-8") as reader:
+                texts.append(reader.read())
+    return texts
+
+
+def random_texts(count, seed=42):
+    rng = random.Random(seed)
+    return ["".join(rng.choice(NORMALIZE_SPECIAL_CHARS) for _ in range(rng.randint(0, 16))) for _ in range(count)]
+
+
+def time_normalize(normalize, texts, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for text in texts:
+            normalize(text)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(corpus_dir, repeats=5):
+    texts = load_texts(corpus_dir)
+    print(f"{len(texts)} texts, {sum(len(text) for text in texts) / 1e6:.1f}M characters")
+
+    for name, samples in (("corpus", texts), ("random", random_texts(100000))):
+        mismatches = [text for text in samples if normalize_text(text) != _normalize_text_by_passes(text)]
+        if mismatches:
+            print(f"Output differs for {len(mismatches)} {name} texts, e.g. {mismatches[:3]!r}")
+            sys.exit(1)
+        print(f"{name}: identical output for all {len(samples)} texts")
+
+    passes = time_normalize(_normalize_text_by_passes, texts, repeats)
+    anchored = time_normalize(normalize_text, texts, repeats)
+    print(f"one pass per rule: {passes * 1000:.2f} ms")
+    print(f"normalize_text:    {anchored * 1000:.2f} ms")
+    print(f"speedup:           {passes / anchored:.2f}x")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python3 benchmark_normalize.py <corpus dir> [repeats]")
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else 5)
@@ -0,0 +1,55 @@
+"""
+Microbenchmark of the trie-based WordpieceTokenizer against the substring-probing reference,
+over the words of a real webpage.
+
+Usage: python3 benchmark_wordpiece.py <url or text file> [repeats]
+"""
+import sys
+import time
+
+from crawl_website import download_and_clean_html
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+
+def load_words(source, tokenizer):
+    if source.startswith("http://") or source.startswith("https://"):
+        text = download_and_clean_html(source)
+    else:
+        with open(source, "r", encoding="utf-8") as reader:
+            text = reader.read()
+    return tokenizer.basic_tokenizer.tokenize(text)
+
+
+def time_tokenize(tokenize, words, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for word in words:
+            tokenize(word)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(source, repeats=5):
+    tokenizer = BertTokenizer.from_pretrained("spanbert-base-cased", do_lower_case=False)
+    wordpiece = tokenizer.wordpiece_tokenizer
+    words = load_words(source, tokenizer)
+    print(f"{len(words)} words ({len(set(words))} distinct)")
+
+    mismatches = [w for w in words if wordpiece.tokenize(w) != wordpiece._tokenize_by_substrings(w)]
+    if mismatches:
+        print(f"Output differs for {len(mismatches)} words, e.g. {mismatches[:5]}")
+        sys.exit(1)
+
+    substrings = time_tokenize(wordpiece._tokenize_by_substrings, words, repeats)
+    trie = time_tokenize(wordpiece.tokenize, words, repeats)
+    print(f"substring probing: {substrings * 1000:.2f} ms")
+    print(f"trie:              {trie * 1000:.2f} ms")
+    print(f"speedup:           {substrings / trie:.2f}x")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python3 benchmark_wordpiece.py <url or text file> [repeats]")
+        sys.exit(1)
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) == 3 else 5)
@@ -1,29 +1,278 @@
+import asyncio
+import codecs
+import queue
 import requests
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from bs4 import BeautifulSoup
+from html.parser import HTMLParser
 import logging
 import io
 
-def download_and_clean_html(url):
-    """ Reads an HTML file, extracts text, and cleans it for indexing. """
+from page_cache import PageCache
+
+# On-disk cache of downloaded pages and their cleaned text (see page_cache.py); set
+# PAGE_CACHE_DIR to None to always download. Change these before the first download.
+PAGE_CACHE_DIR = "./page_cache"
+PAGE_CACHE_TTL = 24 * 3600
+PAGE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Limits of `download_many`: connections open at once, in total and to any one host.
+MAX_CONNECTIONS = 16
+MAX_CONNECTIONS_PER_HOST = 4
+FETCH_TIMEOUT = 30
+
+# Characters of cleaned text kept per page.
+MAX_TEXT_CHARS = 10000
+# Streaming downloads (see `PageReader`) stop once this much visible text has been parsed,
+# which leaves headroom for what cleaning removes, or after MAX_PAGE_BYTES.
+STREAM_PAGES = True
+STREAM_TEXT_CHARS = MAX_TEXT_CHARS * 3 // 2
+MAX_PAGE_BYTES = 4 * 1024 * 1024
+CHUNK_SIZE = 16 * 1024
+
+# Parser that extracts the text of a page in `clean_html`: "selectolax", "lxml", "bs4"
+# (BeautifulSoup's html.parser), or "auto" for the fastest one installed.
+HTML_BACKEND = "auto"
+
+# One connection pool for all blocking downloads, so connections to a host are reused.
+_session = requests.Session()
+_page_cache = None
+_page_cache_lock = threading.Lock()
+
+def get_page_cache():
+    """ The shared page cache, or None when caching is disabled. """
+    global _page_cache
+    if PAGE_CACHE_DIR is None:
+        return None
+    with _page_cache_lock:
+        if _page_cache is None:
+            _page_cache = PageCache(PAGE_CACHE_DIR, ttl=PAGE_CACHE_TTL, max_bytes=PAGE_CACHE_MAX_BYTES,
+                                    timeout=FETCH_TIMEOUT, session=_session, read=read_html)
+    return _page_cache
+
+class UnsupportedContentError(requests.RequestException):
+    """ The response is not an HTML or text page (e.g. a PDF or an image). """
+
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset=["']?([\w.:-]+)""", re.IGNORECASE)
+
+def _is_text_content_type(content_type):
+    mime = content_type.split(";")[0].strip().lower()
+    return mime.startswith("text/") or mime.endswith("/xml") or mime.endswith("+xml")
+
+def _charset(content_type, head):
+    """ The declared charset of a page: from its Content-Type header, else from a <meta> tag in
+        its first bytes; utf-8 when there is none or it is unknown. """
+    match = re.search(r"charset=[\"']?([\w.:-]+)", content_type or "", re.IGNORECASE)
+    if match is None:
+        match = _META_CHARSET.search(head[:4096])
+        charset = match.group(1).decode("ascii", "replace") if match else "utf-8"
+    else:
+        charset = match.group(1)
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        return "utf-8"
+
+class _VisibleTextCounter:
+    """ Counts the characters `clean_html` would extract, skipping <script>, <style> and <template>.
+        It is the target of lxml's incremental HTMLParser, which tokenizes in C and only calls
+        back into Python for tags and text. """
+
+    _SKIPPED = ("script", "style", "template")
+
+    def __init__(self):
+        self.chars = 0
+        self._skipping = 0
+
+    def start(self, tag, attrib):
+        if tag in self._SKIPPED:
+            self._skipping += 1
+
+    def end(self, tag):
+        if tag in self._SKIPPED and self._skipping:
+            self._skipping -= 1
+
+    def data(self, data):
+        if not self._skipping:
+            data = data.strip()
+            if data:
+                self.chars += len(data) + 1
+
+    def close(self):
+        return self.chars
+
+class _StdlibTextCounterParser(HTMLParser):
+    """ Feeds a `_VisibleTextCounter` from the pure-Python html.parser, when lxml is missing. """
+
+    def __init__(self, target):
+        super().__init__(convert_charrefs=True)
+        self.target = target
+
+    def handle_starttag(self, tag, attrs):
+        self.target.start(tag, attrs)
+
+    def handle_endtag(self, tag):
+        self.target.end(tag)
+
+    def handle_data(self, data):
+        self.target.data(data)
+
+def _text_counter_parser(counter):
+    try:
+        from lxml import etree
+    except ImportError:
+        return _StdlibTextCounterParser(counter)
+    return etree.HTMLParser(target=counter)
+
+class PageReader:
+    """ Reads an HTML response incrementally: `feed` it the body chunk by chunk until it returns
+        True, then take the HTML read so far from `html`.
+
+        The body is decoded with its declared charset and fed to an incremental HTML parser;
+        reading stops once `text_chars` characters of visible text or `max_bytes` bytes have
+        been read. Responses that are not text, by Content-Type or by their first bytes, raise
+        UnsupportedContentError before any of the body is kept.
+    """
+
+    def __init__(self, content_type=None, text_chars=STREAM_TEXT_CHARS, max_bytes=MAX_PAGE_BYTES):
+        if content_type and not _is_text_content_type(content_type):
+            raise UnsupportedContentError(f"Not an HTML page: {content_type}")
+        self.content_type = content_type or ""
+        self.text_chars = text_chars
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.truncated = False
+        self._decoder = None
+        self._parts = []
+        self._counter = _VisibleTextCounter()
+        self._parser = _text_counter_parser(self._counter)
+
+    def feed(self, chunk):
+        if not chunk:
+            return False
+        if self._decoder is None:
+            charset = _charset(self.content_type, chunk)
+            if chunk.startswith(b"%PDF") or (b"\x00" in chunk[:1024] and not charset.startswith("utf-16")):
+                raise UnsupportedContentError("Not an HTML page: binary content")
+            self._decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+        self.bytes_read += len(chunk)
+        text = self._decoder.decode(chunk)
+        self._parts.append(text)
+        self._parser.feed(text)
+        if self._counter.chars >= self.text_chars or self.bytes_read >= self.max_bytes:
+            self.truncated = True
+        return self.truncated
+
+    def html(self):
+        if self._decoder is not None and not self.truncated:
+            self._parts.append(self._decoder.decode(b"", final=True))
+        return "".join(self._parts)
+
+def decode_html(content, content_type=None):
+    """ Decodes the bytes of a page with its declared charset (see `_charset`). """
+    return content.decode(_charset(content_type, content), errors="replace")
+
+def read_html(response):
+    """ The HTML of a `requests` response opened with stream=True. With STREAM_PAGES, the body is
+        read in chunks through a `PageReader` and the download stops early on long pages. """
+    if not STREAM_PAGES:
+        return decode_html(response.content, response.headers.get("Content-Type"))
+    try:
+        reader = PageReader(response.headers.get("Content-Type"))
+        for chunk in response.iter_content(CHUNK_SIZE):
+            if reader.feed(chunk):
+                break
+    finally:
+        response.close()
+    return reader.html()
+
+def download_html(url):
+    """ Fetches the raw HTML of a webpage. """
 
     print("Fetching text from url ...")
 
-    response = requests.get(url, timeout=30)
+    response = _session.get(url, timeout=FETCH_TIMEOUT, stream=True)
     response.raise_for_status()
-    soup = BeautifulSoup(response.text, "html.parser")
+    return read_html(response)
 
-    selected_tags = soup.find_all(string=True)
+def html_backend(backend=None):
+    """ Resolves `backend` (HTML_BACKEND by default) to the name of an installed parser. """
+    backend = backend or HTML_BACKEND
+    if backend != "auto":
+        if backend not in _TEXT_EXTRACTORS:
+            raise ValueError(f"Unknown HTML backend '{backend}', expected one of {sorted(_TEXT_EXTRACTORS)}")
+        return backend
+    for name, module in (("selectolax", "selectolax"), ("lxml", "lxml")):
+        try:
+            __import__(module)
+            return name
+        except ImportError:
+            pass
+    return "bs4"
 
-    if not selected_tags:
-        logging.warning(f"No matching tags found in {url}")
+def _bs4_text(html):
+    soup = BeautifulSoup(html, "html.parser")
+    return soup.get_text(separator=' ', strip=True)
+
+def _lxml_text(html):
+    from lxml import etree, html as lxml_html
+    try:
+        # Parse utf-8 bytes: lxml refuses str input with an XML encoding declaration.
+        root = lxml_html.document_fromstring(html.encode("utf-8"), parser=lxml_html.HTMLParser(encoding="utf-8"))
+    except etree.ParserError:
+        # Nothing but whitespace or comments.
+        return ""
+    # html.parser and lexbor keep <template> contents out of the document text; libxml2 does not.
+    etree.strip_elements(root, "script", "style", "template", with_tail=False)
+    # itertext already skips comments and processing instructions.
+    return " ".join(text for text in (text.strip() for text in root.itertext()) if text)
+
+def _selectolax_text(html):
+    from selectolax.lexbor import LexborHTMLParser
+    tree = LexborHTMLParser(html)
+    if tree.root is None:
         return ""
-    
-    # text = " ".join(tag.get_text(separator=" ") for tag in selected_tags if tag.get_text())
-    text = soup.get_text(separator=' ', strip=True)
-    # text = " ".join(soup.stripped_strings)
+    tree.strip_tags(["script", "style"])
+    # Join on a private-use character first so the empty text nodes can be dropped.
+    texts = tree.root.text(deep=True, separator='\ue000', strip=True).split('\ue000')
+    return " ".join(text for text in texts if text)
+
+_TEXT_EXTRACTORS = {"bs4": _bs4_text, "lxml": _lxml_text, "selectolax": _selectolax_text}
+
+def extract_text(html, backend=None):
+    """ The visible text of a page, without <script>/<style>/<template> contents or comments:
+        every text node stripped, non-empty ones joined by single spaces, as BeautifulSoup's
+        `get_text(separator=' ', strip=True)` does.
 
+        After `normalize_text` the backends agree on ordinary pages (lxml and selectolax turn
+        \r\n into \n, which only matters before lines are split). They differ where
+        html.parser departs from HTML5 parsing: lxml and selectolax drop CDATA sections, and
+        keep markup inside <textarea>, <iframe> and <plaintext> as literal text. """
+    return _TEXT_EXTRACTORS[html_backend(backend)](html)
 
+# The spacing rules of `normalize_text`, each anchored on the bracket or punctuation it applies
+# to: `re` only tries a match where the first character fits, and these are far rarer than
+# whitespace. Space *before* punctuation is matched after it in the reversed text.
+_SPACE_AFTER_OPENING = re.compile(r"([(\[])\s+")
+_SPACE_BEFORE_CLOSING_REVERSED = re.compile(r"([.,;:!?)\]])\s+")
+
+def normalize_text(text):
+    """ Normalizes extracted page text: drops non-breaking spaces, the space before punctuation
+        and closing brackets and after opening brackets, and blank lines, and strips every line.
+        Same output as `_normalize_text_by_passes`, with two regex scans instead of five. """
+    text = _SPACE_AFTER_OPENING.sub(r"\1", text.replace('\xa0', ''))
+    text = _SPACE_BEFORE_CLOSING_REVERSED.sub(r"\1", text[::-1])[::-1]
+    return "\n".join(line.strip() for line in text.splitlines() if line and not line.isspace())
+
+# The characters the rules of `normalize_text` treat specially: brackets, punctuation, and
+# whitespace and line breaks of every kind. Random strings of them check it against the reference.
+NORMALIZE_SPECIAL_CHARS = list("ab.,;:!?()[] ") + ["\n", "\r", "\r\n", "\t", "\v", "\f", "\x1c", "\x1f",
+                                                  "\x85", "\xa0", "\u2028", "\u2029", "\u3000"]
+
+def _normalize_text_by_passes(text):
+    """ Reference implementation of `normalize_text`, one pass per rule. """
     text = text.replace('\xa0', '')
     text = re.sub(r'\s+([.,;:!?])', r'\1', text)
     text = re.sub(r'\(\s+', '(', text)
@@ -31,13 +280,157 @@ def download_and_clean_html(url):
     text = re.sub(r'\[\s+', '[', text)    # remove space after opening square bracket
     text = re.sub(r'\s+\]', ']', text)    # remove space before closing square bracket
 
-
     lines = text.splitlines()
     non_blank_lines = [line.strip() for line in lines if line.strip()]
-    text = "\n".join(non_blank_lines)
+    return "\n".join(non_blank_lines)
 
-    if len(text) > 10000:
-        print(f"Trimming webpage content from {len(text)} to 10000 characters")
-        text = text[:10000]
+def clean_html(html, url="", backend=None):
+    """ Extracts text from raw HTML and cleans it for indexing. """
+    text = extract_text(html, backend)
+
+    if not text:
+        logging.warning(f"No matching tags found in {url}")
+        return ""
+
+    text = normalize_text(text)
+
+    if len(text) > MAX_TEXT_CHARS:
+        print(f"Trimming webpage content from {len(text)} to {MAX_TEXT_CHARS} characters")
+        text = text[:MAX_TEXT_CHARS]
           
-    return text
\ No newline at end of file
+    return text
+
+def _text_variant():
+    # Backends differ in details, so the page cache keeps the text of each one apart.
+    return "text-" + html_backend()
+
+def fetch_page(url):
+    """ Returns (html, text) for a webpage: its cleaned text, with html None, when the page cache
+        has it for an unchanged page, otherwise its raw HTML with text None. """
+    cache = get_page_cache()
+    if cache is None:
+        return download_html(url), None
+
+    print("Fetching text from url ...")
+    return cache.fetch(url, _text_variant())
+
+def clean_page(html, text, url=""):
+    """ Cleans a page returned by `fetch_page`, caching the text; cached text is returned as is. """
+    if text is not None:
+        return text
+    text = clean_html(html, url)
+    cache = get_page_cache()
+    if cache is not None:
+        cache.store_text(url, html, text, _text_variant())
+    return text
+
+def download_and_clean_html(url):
+    """ Reads an HTML file, extracts text, and cleans it for indexing. """
+    html, text = fetch_page(url)
+    return clean_page(html, text, url)
+
+def download_many(urls, max_connections=MAX_CONNECTIONS, max_per_host=MAX_CONNECTIONS_PER_HOST):
+    """ Downloads every url concurrently and yields (url, html, text, error) as each one completes,
+        where (html, text) is what `fetch_page` returns and error the exception of a failed download.
+
+        The downloads share one asyncio HTTP client (aiohttp) with a connection pool and DNS cache;
+        at most `max_connections` run at once, and at most `max_per_host` against any one host.
+        Without aiohttp, they run on a thread pool over `fetch_page` instead.
+    """
+    urls = list(urls)
+    try:
+        import aiohttp
+    except ImportError:
+        logging.warning("aiohttp is not installed; downloading pages with a thread pool instead.")
+        yield from _download_many_threaded(urls, max_connections)
+        return
+
+    results = queue.Queue()
+
+    def run():
+        try:
+            asyncio.run(_download_all(aiohttp, urls, results, max_connections, max_per_host))
+        except BaseException as e:
+            results.put(e)
+
+    threading.Thread(target=run, name="download-many", daemon=True).start()
+    for _ in urls:
+        result = results.get()
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+def _accept_encoding():
+    try:
+        import brotli  # aiohttp decodes "br" responses with it
+        return "gzip, deflate, br"
+    except ImportError:
+        return "gzip, deflate"
+
+async def _download_all(aiohttp, urls, results, max_connections, max_per_host):
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_per_host, ttl_dns_cache=300)
+    # Like the requests timeout: per connection attempt and per read, not for the whole download.
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=FETCH_TIMEOUT, sock_read=FETCH_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     headers={"Accept-Encoding": _accept_encoding()}) as session:
+        async def download(url):
+            try:
+                html, text = await _fetch_page_async(session, url)
+            except Exception as e:
+                results.put((url, None, None, e))
+            else:
+                results.put((url, html, text, None))
+
+        await asyncio.gather(*(download(url) for url in urls))
+
+async def _get(session, url, headers=None):
+    async with session.get(url, headers=headers) as response:
+        if response.status == 304:
+            return response.status, None, response.headers
+        response.raise_for_status()
+        if not STREAM_PAGES:
+            # Decoded like the streamed pages, not with aiohttp's charset detection.
+            html = decode_html(await response.read(), response.headers.get("Content-Type"))
+            return response.status, html, response.headers
+        reader = PageReader(response.headers.get("Content-Type"))
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            # Parsing is CPU work; keep it off the event loop like the page cache calls.
+            if await asyncio.to_thread(reader.feed, chunk):
+                break
+        return response.status, reader.html(), response.headers
+
+async def _fetch_page_async(session, url):
+    """ `fetch_page` on the asyncio client. The page cache reads and writes files under a lock,
+        so its calls run on worker threads instead of blocking the event loop. """
+    cache = await asyncio.to_thread(get_page_cache)
+    if cache is None:
+        _, html, _ = await _get(session, url)
+        return html, None
+
+    variant = _text_variant()
+    page = await asyncio.to_thread(cache.cached, url, variant)
+    if page is not None:
+        return page
+    validators = await asyncio.to_thread(cache.validators, url)
+    status, html, headers = await _get(session, url, validators)
+    if status == 304:
+        page = await asyncio.to_thread(cache.revalidated, url, variant)
+        if page is not None:
+            return page
+        # The cached files are gone; download the page again without validators.
+        status, html, headers = await _get(session, url)
+    return await asyncio.to_thread(cache.store_html, url, html, headers, variant)
+
+def _download_many_threaded(urls, max_workers):
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(fetch_page, url): url for url in urls}
+    try:
+        for future in as_completed(futures):
+            try:
+                html, text = future.result()
+            except Exception as e:
+                yield futures[future], None, None, e
+            else:
+                yield futures[future], html, text, None
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,84 @@
+"""
+Distills the SpanBERT classifier into the span-pair relation model of span_pair.py, which
+encodes every sentence once and classifies all of its candidate pairs together. The student
+starts from SpanBERT's encoder weights and is trained with BertAdam on SpanBERT's softened
+predictions; its label agreement with SpanBERT is reported at the end.
+
+Usage: python3 distill_span_pair.py <pretrained dir> <examples.json> <output dir> [epochs]
+where examples.json holds a list of {"tokens": [...], "subj": [...], "obj": [...]} pairs.
+"""
+import json
+import os
+import sys
+import time
+
+import torch
+
+from pytorch_pretrained_bert.file_utils import CONFIG_NAME, WEIGHTS_NAME
+from pytorch_pretrained_bert.modeling import BertForSpanPairClassification
+from span_pair import (NUM_ENTITY_TYPES, SpanPairBERT, build_sentence_batches,
+                       convert_examples_to_sentences)
+from spanbert import SpanBERT, bert_optimizer, compare_predictions, distillation_loss, label_list
+
+BATCH_SIZE = 16
+LEARNING_RATE = 5e-5
+TEMPERATURE = 2.0
+MAX_SEQ_LENGTH = 256
+
+
+def main(pretrained_dir, examples_file, output_dir, epochs=3):
+    with open(examples_file, "r", encoding="utf-8") as reader:
+        examples = json.load(reader)
+
+    teacher = SpanBERT(pretrained_dir)
+    print(f"Labelling {len(examples)} candidate pairs with SpanBERT ...")
+    teacher_logits = torch.from_numpy(teacher.predict_logits(examples))
+    teacher_preds = teacher.predict(examples)
+    device = teacher.device
+    tokenizer = teacher.tokenizer
+    sentences, pairs = convert_examples_to_sentences(examples, tokenizer, MAX_SEQ_LENGTH)
+    del teacher
+
+    student = BertForSpanPairClassification.from_pretrained(
+        pretrained_dir, num_labels=len(label_list), num_entity_types=NUM_ENTITY_TYPES)
+    student.to(device)
+    num_batches = (len(sentences) + BATCH_SIZE - 1) // BATCH_SIZE
+    optimizer = bert_optimizer(student, LEARNING_RATE, num_batches * epochs)
+
+    for epoch in range(epochs):
+        student.train()
+        total_loss = 0.0
+        start = time.perf_counter()
+        for input_ids, input_mask, pair_spans, pair_types, indices in build_sentence_batches(
+                sentences, pairs, BATCH_SIZE, shuffle=True, seed=epoch):
+            logits = student(input_ids.to(device), None, input_mask.to(device),
+                             pair_spans=pair_spans.to(device), pair_types=pair_types.to(device))
+            loss = distillation_loss(logits, teacher_logits[indices].to(device), TEMPERATURE)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            total_loss += loss.item()
+        print(f"Epoch {epoch + 1}/{epochs}: loss {total_loss / max(num_batches, 1):.4f} "
+              f"({time.perf_counter() - start:.1f}s)")
+
+    os.makedirs(output_dir, exist_ok=True)
+    torch.save(student.state_dict(), os.path.join(output_dir, WEIGHTS_NAME))
+    with open(os.path.join(output_dir, CONFIG_NAME), "w", encoding="utf-8") as writer:
+        writer.write(student.config.to_json_string())
+    tokenizer.save_vocabulary(output_dir)
+    print(f"Saved the span-pair model to {output_dir}")
+
+    start = time.perf_counter()
+    student_preds = SpanPairBERT(output_dir).predict(examples)
+    print(f"Span-pair model: {len(examples)} pairs from {len(sentences)} sentences "
+          f"in {time.perf_counter() - start:.2f}s")
+    report = compare_predictions(teacher_preds, student_preds)
+    print(f"Label agreement with SpanBERT: {report['label_agreement']:.4f}")
+    print(f"Mean confidence drift:         {report['mean_confidence_drift']:.5f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5):
+        print("Usage: python3 distill_span_pair.py <pretrained dir> <examples.json> <output dir> [epochs]")
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2], sys.argv[3], int(sys.argv[4]) if len(sys.argv) == 5 else 3)
@@ -0,0 +1,191 @@
+"""
+Distills the SpanBERT classifier into a smaller BertForSequenceClassification student for CPU
+extraction, then reports its speed and agreement against the teacher on held-out pairs.
+
+The training pairs are the `create_entity_pairs` candidates of a corpus of pages, labelled
+with the teacher's softened predictions; the student is trained with BertAdam. The student
+is saved with its config and vocabulary, so `SpanBERT(<output dir>)` serves it.
+
+Usage: python3 distill_student.py <pretrained dir> <pages> <output dir> [layers] [hidden size] [epochs]
+where <pages> is a directory of cleaned page texts (*.txt) or a file with one URL per line.
+Defaults: 4 layers, the teacher's hidden size, 3 epochs.
+"""
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+
+from crawl_website import download_and_clean_html
+from models import get_nlp
+from pytorch_pretrained_bert.file_utils import CONFIG_NAME, WEIGHTS_NAME
+from pytorch_pretrained_bert.modeling import BertConfig, BertForSequenceClassification
+from spacy_help_functions import create_entity_pairs
+from spanbert import (SpanBERT, bert_optimizer, compare_predictions, convert_examples_to_ids,
+                      distillation_loss, special_tokens, timed_predict)
+
+ENTITIES_OF_INTEREST = ["PERSON", "ORGANIZATION", "LOCATION", "CITY", "STATE_OR_PROVINCE", "COUNTRY"]
+BATCH_SIZE = 32
+LEARNING_RATE = 1e-4
+TEMPERATURE = 2.0
+HELD_OUT = 0.1
+
+
+def load_pages(source):
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith(".txt"):
+                with open(os.path.join(source, name), "r", encoding="utf-8") as reader:
+                    yield reader.read()
+    else:
+        with open(source, "r", encoding="utf-8") as reader:
+            urls = [line.strip() for line in reader if line.strip()]
+        for url in urls:
+            try:
+                yield download_and_clean_html(url)
+            except Exception as e:
+                print(f"Skipping {url}: {e}")
+
+
+def candidate_pairs(pages):
+    """Every entity pair of every sentence, in both directions when the subject can be one."""
+    nlp = get_nlp()
+    examples = []
+    for text in pages:
+        for sentence in nlp(text).sents:
+            for tokens, e1, e2 in create_entity_pairs(sentence, ENTITIES_OF_INTEREST):
+                for subj, obj in ((e1, e2), (e2, e1)):
+                    if "SUBJ=" + subj[1] in special_tokens and "OBJ=" + obj[1] in special_tokens:
+                        examples.append({"tokens": tokens, "subj": subj, "obj": obj})
+    return examples
+
+
+def student_attention_heads(hidden_size):
+    """The most heads of at least 64 dimensions that evenly divide `hidden_size`, and at least one."""
+    heads = max(hidden_size // 64, 1)
+    while hidden_size % heads:
+        heads -= 1
+    return heads
+
+
+def build_student(teacher_model, num_layers, hidden_size, num_labels):
+    """A student config with the teacher's vocabulary. With the teacher's hidden size it keeps
+    the teacher's attention heads and intermediate size, and starts from the teacher's
+    embeddings, head and evenly spaced encoder layers."""
+    teacher_config = teacher_model.config
+    same_width = hidden_size == teacher_config.hidden_size
+    config = BertConfig(teacher_config.vocab_size,
+                        hidden_size=hidden_size,
+                        num_hidden_layers=num_layers,
+                        num_attention_heads=(teacher_config.num_attention_heads if same_width
+                                             else student_attention_heads(hidden_size)),
+                        intermediate_size=teacher_config.intermediate_size if same_width else 4 * hidden_size,
+                        hidden_act=teacher_config.hidden_act,
+                        max_position_embeddings=teacher_config.max_position_embeddings,
+                        type_vocab_size=teacher_config.type_vocab_size)
+    student = BertForSequenceClassification(config, num_labels=num_labels)
+    if not same_width:
+        print(f"Hidden size {hidden_size} differs from the teacher's {teacher_config.hidden_size}; "
+              f"the student starts from random weights")
+        return student
+
+    teacher_layers = np.linspace(0, teacher_config.num_hidden_layers - 1, num_layers).round().astype(int)
+    pairs = [(student.bert.embeddings, teacher_model.bert.embeddings),
+             (student.bert.pooler, teacher_model.bert.pooler),
+             (student.classifier, teacher_model.classifier)]
+    pairs += [(layer, teacher_model.bert.encoder.layer[i]) for layer, i in zip(student.bert.encoder.layer, teacher_layers)]
+    for student_module, teacher_module in pairs:
+        student_shapes = {name: tuple(t.shape) for name, t in student_module.state_dict().items()}
+        teacher_shapes = {name: tuple(t.shape) for name, t in teacher_module.state_dict().items()}
+        if student_shapes != teacher_shapes:
+            mismatched = sorted(set(student_shapes.items()) ^ set(teacher_shapes.items()))
+            print(f"Not copying the teacher's weights, their shapes differ from the student's: {mismatched[:4]}")
+            return student
+    for student_module, teacher_module in pairs:
+        student_module.load_state_dict(teacher_module.state_dict())
+    return student
+
+
+def training_batches(all_input_ids, targets, batch_size, seed):
+    """Shuffled batches of (input_ids, input_mask, segment_ids, target logits), padded per batch."""
+    order = list(range(len(all_input_ids)))
+    random.Random(seed).shuffle(order)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        width = max(len(all_input_ids[i]) for i in batch)
+        input_ids = np.zeros((len(batch), width), dtype=np.int64)
+        input_mask = np.zeros((len(batch), width), dtype=np.int64)
+        for row, i in enumerate(batch):
+            input_ids[row, :len(all_input_ids[i])] = all_input_ids[i]
+            input_mask[row, :len(all_input_ids[i])] = 1
+        input_ids = torch.from_numpy(input_ids)
+        yield input_ids, torch.from_numpy(input_mask), torch.zeros_like(input_ids), targets[batch]
+
+
+def main(pretrained_dir, pages, output_dir, num_layers=4, hidden_size=None, epochs=3):
+    examples = candidate_pairs(load_pages(pages))
+    random.Random(42).shuffle(examples)
+    num_held_out = max(int(len(examples) * HELD_OUT), 1)
+    held_out, train = examples[:num_held_out], examples[num_held_out:]
+    print(f"{len(train)} training and {len(held_out)} held-out candidate pairs")
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, "examples.json"), "w", encoding="utf-8") as writer:
+        json.dump(examples, writer)
+
+    teacher = SpanBERT(pretrained_dir)
+    print("Labelling the training pairs with the teacher ...")
+    targets = torch.from_numpy(teacher.predict_logits(train))
+    teacher_model = teacher.classifier.float().cpu()
+    hidden_size = hidden_size or teacher_model.config.hidden_size
+    student = build_student(teacher_model, num_layers, hidden_size, teacher.num_labels)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    student.to(device)
+
+    all_input_ids = convert_examples_to_ids(train, teacher.max_seq_length, teacher.tokenizer, special_tokens)
+    num_batches = (len(train) + BATCH_SIZE - 1) // BATCH_SIZE
+    optimizer = bert_optimizer(student, LEARNING_RATE, num_batches * epochs)
+
+    for epoch in range(epochs):
+        student.train()
+        total_loss = 0.0
+        start = time.perf_counter()
+        for input_ids, input_mask, segment_ids, batch_targets in training_batches(all_input_ids, targets,
+                                                                                   BATCH_SIZE, seed=epoch):
+            logits = student(input_ids.to(device), segment_ids.to(device), input_mask.to(device))
+            loss = distillation_loss(logits, batch_targets.to(device), TEMPERATURE)
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            total_loss += loss.item()
+        print(f"Epoch {epoch + 1}/{epochs}: loss {total_loss / max(num_batches, 1):.4f} "
+              f"({time.perf_counter() - start:.1f}s)")
+
+    torch.save(student.state_dict(), os.path.join(output_dir, WEIGHTS_NAME))
+    with open(os.path.join(output_dir, CONFIG_NAME), "w", encoding="utf-8") as writer:
+        writer.write(student.config.to_json_string())
+    teacher.tokenizer.save_vocabulary(output_dir)
+    print(f"Saved the student to {output_dir}")
+
+    del teacher, teacher_model
+    teacher_preds, teacher_time = timed_predict(SpanBERT(pretrained_dir), held_out)
+    student_preds, student_time = timed_predict(SpanBERT(output_dir), held_out)
+    report = compare_predictions(teacher_preds, student_preds)
+    print(f"Student: {num_layers} layers, hidden size {hidden_size}, "
+          f"{sum(p.numel() for p in student.parameters()) / 1e6:.1f}M parameters")
+    print(f"Held-out pairs:        {report['examples']}")
+    print(f"Label agreement:       {report['label_agreement']:.4f}")
+    print(f"Mean confidence drift: {report['mean_confidence_drift']:.5f}")
+    print(f"teacher: {teacher_time:.2f}s ; student: {student_time:.2f}s ({teacher_time / student_time:.2f}x)")
+
+
+if __name__ == "__main__":
+    if not 4 <= len(sys.argv) <= 7:
+        print("Usage: python3 distill_student.py <pretrained dir> <pages> <output dir> [layers] [hidden size] [epochs]")
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2], sys.argv[3],
+         int(sys.argv[4]) if len(sys.argv) > 4 else 4,
+         int(sys.argv[5]) if len(sys.argv) > 5 else None,
+         int(sys.argv[6]) if len(sys.argv) > 6 else 3)
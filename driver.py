@@ -1,11 +1,14 @@
 import requests
 import json
+import heapq
+import itertools
 
-from crawl_website import download_and_clean_html
+from crawl_website import MAX_TEXT_CHARS, download_many, clean_page
 from extract_relations import ExtractRelations
+from models import get_nlp, registry
+from pipeline import Pipeline, Stage
 
 import time
-import google.generativeai as palm
 
 RELATION_MAP = {
     1: "per:schools_attended",
@@ -14,8 +17,18 @@ RELATION_MAP = {
     4: "org:top_members/employees"
 }
 
+# Worker threads per pipeline stage; they share the CPU. Pages are downloaded
+# concurrently by `download_many` before the first stage.
+STAGE_WORKERS = {
+    "clean": 2,
+    "annotate": 1,
+    "pair": 1,
+    "classify": 1
+}
+
 class InfoExtraction:
-    def __init__(self, model, google_api_key, google_engine_id, google_gemini_api_key, r, t, q, k):
+    def __init__(self, model, google_api_key, google_engine_id, google_gemini_api_key, r, t, q, k,
+                 stage_workers=None, queue_size=4):
         """Recieve the target precision and user's query. """
         self.model = model
         self.google_api_key = google_api_key
@@ -25,8 +38,15 @@ class InfoExtraction:
         self.threshold = t 
         self.query = q 
         self.tuple_num = k
-        self.X = set()
+        self.X = {}  # (subject, object) -> (subject, relation, object, confidence)
         self.iteration = 0
+        self.query_queue = []
+        self._query_order = itertools.count()
+        self.used_queries = set()
+        self.seen_urls = set()
+        self.timings = {}
+        self.stage_workers = stage_workers or {}
+        self.queue_size = queue_size
         relation_map = {
             1: "Schools_Attended",
             2: "Work_For",
@@ -48,8 +68,6 @@ class InfoExtraction:
             "Top_Member_Employees": ("PERSON", "ORG")
         }
 
-        # self.nlp = spacy.load("en_core_web_lg") 
-        # self.spanbert = SpanBERT("SpanBERT/pretrained_spanbert")
         self.entities_of_interest = ["ORGANIZATION", "PERSON", "LOCATION", "CITY", "STATE_OR_PROVINCE", "COUNTRY"]
         self.target_relation = RELATION_MAP[self.r]
   
@@ -67,74 +85,179 @@ Query           = {self.query}
 # of Tuples     = {self.tuple_num}
 
 Loading necessary libraries; This should take a minute or so ...
-========== Iteration: {self.iteration} - Query: {self.query} ==========
 """)
-        unique_tuples = set()
-        
+        # Load the models in the background while the first search and page fetches run.
+        self._started = time.perf_counter()
+        registry.preload("spacy")
+        if self.model == "-spanbert":
+            registry.preload("spanbert")
+
+        while True:
+            print(f"========== Iteration: {self.iteration} - Query: {self.query} ==========\n")
+            self.used_queries.add(self.query.lower())
+            self.run_iteration()
+
+            if self.iteration == 0:
+                self.print_startup_timings()
+
+            if len(self.X) >= self.tuple_num:
+                break
+
+            next_query = self.next_query()
+            if next_query is None:
+                print("ISE has stalled before retrieving k high-confidence tuples.")
+                break
+            self.query = next_query
+            self.iteration += 1
+
+        print(f"\n================== ALL RELATIONS for {self.relation} ( {len(self.X)} ) =================")
+        final_tuples = sorted(self.X.values(), key=lambda x: x[3], reverse=True)
+        if self.model == "-spanbert":
+            final_tuples = final_tuples[:self.tuple_num]
+        for relation_tuple in final_tuples:
+            print(relation_tuple)
+        print(f"Total # of iterations = {self.iteration + 1}")
+
+        return final_tuples
+
+    def mark(self, event):
+        """Record the first time `event` happens, for the startup timing breakdown."""
+        self.timings.setdefault(event, time.perf_counter())
+
+    def print_startup_timings(self):
+        """Print when each step on the way to the first extracted page finished, relative to start."""
+        events = dict(self.timings)
+        for name, label in (("spacy", "spaCy loaded"), ("spanbert", "SpanBERT loaded + warm-up")):
+            if name in registry.load_times:
+                events[label] = registry.load_times[name][1]
+
+        print("\nStartup timing (seconds since start):")
+        for label, at in sorted(events.items(), key=lambda item: item[1]):
+            print(f"\t{label:<28} {at - self._started:7.2f}")
+        print()
+
+    def run_iteration(self):
+        """Search the current query and extract tuples from every result not fetched before."""
         # Step 1: Get Top 10 URLs from Google Custom Search
         urls = self.google_search()
+        self.mark("Google search done")
         if not urls:
-            print("No results retrieved. Exiting...")
+            print("No results retrieved.")
             return
-        
-        all_tuples = []
 
+        # Step 2: Fetch, clean and extract every unseen result through the staged pipeline
+        items = []
         for idx, result in enumerate(urls):
-            if idx > 0:
-                break
             url = result["url"]
-            print(f"\nURL ({idx+1} / {len(urls)}): {url}")
+            if url in self.seen_urls:
+                print(f"\nURL ({idx+1} / {len(urls)}): {url} was already processed. Skipping...")
+                continue
+            self.seen_urls.add(url)
+            items.append({"idx": idx, "url": url, "total": len(urls)})
 
-            # Step 2: Fetch and clean webpage content
-            webpage_text = download_and_clean_html(url)
-            if not webpage_text:
+        pipeline = self.build_pipeline()
+        for item in pipeline.run(self.fetch_pages(items)):
+            self.mark("First page extracted")
+            webpage_tuples = item["tuples"]
+            print(f"Tuples found for this URL: {len(webpage_tuples)}")
+
+            for tuple_item in webpage_tuples:
+                if self.model == "-spanbert":
+                    self.add_tuple(tuple_item["subject"], tuple_item["object"], tuple_item["confidence"])
+                else:
+                    self.add_tuple(tuple_item[0], tuple_item[2], tuple_item[3])
+
+            if self.model == "-gemini" and len(self.X) >= self.tuple_num:
+                pipeline.stop()
+                break
+
+    def add_tuple(self, subject, obj, confidence):
+        """Index a tuple by (subject, object), keeping its highest confidence, and schedule it as a query."""
+        key = (subject, obj)
+        if key in self.X and self.X[key][3] >= confidence:
+            return
+        self.X[key] = (subject, self.relation, obj, confidence)
+        # heapq is a min-heap: negate the confidence so the best tuple is popped first
+        heapq.heappush(self.query_queue, (-confidence, next(self._query_order), subject, obj))
+
+    def next_query(self):
+        """Pop the highest-confidence tuple that has not been used as a query yet."""
+        while self.query_queue:
+            _, _, subject, obj = heapq.heappop(self.query_queue)
+            query = f"{subject} {obj}"
+            if query.lower() not in self.used_queries:
+                return query
+        return None
+
+    def fetch_pages(self, items):
+        """Download every item's page concurrently, yielding the items in the order they complete."""
+        by_url = {item["url"]: item for item in items}
+        for url, html, text, error in download_many(by_url):
+            item = by_url[url]
+            print(f"\nURL ({item['idx']+1} / {item['total']}): {url}")
+            if error is not None:
                 print("Unable to fetch URL. Skipping...")
                 continue
+            self.mark("First page fetched")
+            item["html"], item["text"] = html, text
+            yield item
+
+    def build_pipeline(self):
+        """Chain clean -> annotate -> pair -> classify for the selected extraction method."""
+        workers = dict(STAGE_WORKERS)
+        workers.update(self.stage_workers)
 
-            if len(webpage_text) > 10000:
-                webpage_text = webpage_text[:10000]
-                print(f"Truncated to 10,000 characters")
+        def stage(name, fn, item_errors=()):
+            return Stage(name, fn, workers=workers[name], queue_size=self.queue_size, item_errors=item_errors)
+
+        def clean(item):
+            webpage_text = clean_page(item.pop("html"), item.pop("text"), item["url"])
+            if not webpage_text:
+                print("Unable to fetch URL. Skipping...")
+                return None
+
+            if len(webpage_text) > MAX_TEXT_CHARS:
+                webpage_text = webpage_text[:MAX_TEXT_CHARS]
+                print("Truncated to 10,000 characters")
             else:
                 print(f"Webpage length (num characters): {len(webpage_text)}")
-            # print(webpage_text)
-            if self.model == "-spanbert":
-                # self.use_spanbert()
-                er = ExtractRelations(self.r, self.threshold)
-                self.chosen_tuples += er.extract_entities_spacy(webpage_text)
-        
+            item["text"] = webpage_text
+            return item
 
-            if self.model == "-gemini":
-                # Ensure the text is a string and not a list
-                if isinstance(webpage_text, list):
-                    webpage_text = ' '.join(webpage_text)
-                
-                webpage_tuples = self.extract_relations_gemini(webpage_text)
-            
-                print(f"Tuples found for this URL: {len(webpage_tuples)}")
-                all_tuples.extend(webpage_tuples)
-
-                # Add only unique tuples
-                for tuple_item in webpage_tuples:
-                    # Convert tuple to a hashable type (lowercase for case-insensitive comparison)
-                    unique_tuple = tuple(str(item).lower() for item in tuple_item)
-                    unique_tuples.add(unique_tuple)
-            
-            if len(all_tuples) >= self.tuple_num:
-                break
-        
-        print("\nExtracted Tuples:")
-        final_tuples = []
-        for unique_tuple in unique_tuples:
-            # Convert back to original representation
-            original_tuple = tuple(unique_tuple)
-            final_tuples.append(original_tuple)
-            print(original_tuple)
-            
-            # Stop if we've reached the desired number of tuples
-            if len(final_tuples) == self.tuple_num:
-                break
+        if self.model == "-spanbert":
+            def annotate(item):
+                item["extractor"] = ExtractRelations(self.r, self.threshold)
+                item["doc"] = item["extractor"].annotate(item.pop("text"))
+                return item
 
-        return final_tuples
+            def pair(item):
+                item["pairs"] = item["extractor"].create_candidate_pairs(item.pop("doc"))
+                return item
+
+            def classify(item):
+                item["tuples"] = list(item.pop("extractor").classify(item.pop("pairs")))
+                return item
+        else:
+            def annotate(item):
+                item["sentences"] = self.extract_sentences(item.pop("text"))
+                return item
+
+            def pair(item):
+                item["sentences"] = self.filter_sentences(item["sentences"])
+                return item
+
+            def classify(item):
+                item["tuples"] = self.classify_sentences_gemini(item.pop("sentences"))
+                return item
+
+        return Pipeline([
+            # A page the parser chokes on is skipped; failures in the later stages (e.g. a
+            # model that does not load) end the run instead of emptying every page.
+            stage("clean", clean, item_errors=(Exception,)),
+            stage("annotate", annotate),
+            stage("pair", pair),
+            stage("classify", classify),
+        ])
 
     def google_search(self):
         """Query the Google API to get the top 10 result. """
@@ -181,7 +304,7 @@ Loading necessary libraries; This should take a minute or so ...
         if not isinstance(text, str):
             text = str(text)
 
-        doc = self.nlp(text)
+        doc = get_nlp()(text)
         sentences = [sent.text.strip() for sent in doc.sents]
 
         print(f"Extracted {len(sentences)} sentences from webpage.")
@@ -213,6 +336,8 @@ Loading necessary libraries; This should take a minute or so ...
         Construct a prompt with the sentence and call the Gemini API.
         Returns a tuple (subject, relation, object, confidence) if successful, else None.
         """
+        # Imported here so SpanBERT runs never pay for loading the Gemini client.
+        import google.generativeai as palm
         palm.configure(api_key=self.google_gemini_api_key)
         
         req_subject, req_object = self.relation_requirements[self.relation]
@@ -260,10 +385,13 @@ Loading necessary libraries; This should take a minute or so ...
             text = ' '.join(text)
         
         sentences_with_entities = self.extract_sentences(text)
-        extracted_tuples = []
-        
+        return self.classify_sentences_gemini(self.filter_sentences(sentences_with_entities))
+
+    def filter_sentences(self, sentences_with_entities):
+        """Keep only the sentences that contain the entity types the relation needs."""
         print(f"Processing {len(sentences_with_entities)} sentences with entities")
-        
+
+        candidates = []
         for sentence, entities in sentences_with_entities:
             # Ensure sentence is a string
             if isinstance(sentence, list):
@@ -276,7 +404,14 @@ Loading necessary libraries; This should take a minute or so ...
             if not self.sentence_has_required_entities(entities):
                 print("Sentence does not have required entities. Skipping.")
                 continue
-            
+            candidates.append(sentence)
+        return candidates
+
+    def classify_sentences_gemini(self, sentences):
+        """Call Gemini on every candidate sentence and return the extracted tuples."""
+        extracted_tuples = []
+        
+        for sentence in sentences:
             # Call Gemini on the sentence
             relation_tuple = self.call_gemini_api(sentence)
             
@@ -1,15 +1,28 @@
-import spacy
-from spanbert import SpanBERT
-from spacy_help_functions import get_entities, create_entity_pairs, extract_relations
+from models import get_nlp, get_spanbert
+from spacy_help_functions import create_entity_pairs
+
+def predict_sentence_pairs(sentence_pairs):
+    """Classify the candidate pairs of every sentence of a page with one batched SpanBERT pass.
+
+    `sentence_pairs` is a per-sentence list of pairs (as returned by `create_candidate_pairs`);
+    the predictions come back with the same nesting.
+    """
+    flat_pairs = [pair for pairs in sentence_pairs for pair in pairs]
+    flat_predictions = get_spanbert().predict(flat_pairs) if flat_pairs else []
+
+    predictions = []
+    offset = 0
+    for pairs in sentence_pairs:
+        predictions.append(flat_predictions[offset:offset + len(pairs)])
+        offset += len(pairs)
+    return predictions
 
-spanbert = SpanBERT("./pretrained_spanbert")
-nlp = spacy.load("en_core_web_lg") 
 
 class ExtractRelations:
-    def __init__(self, r, t):
+    def __init__(self, r, t, document_batching=True):
         self.relation = r
         self.threshold = t
-        self.candidate_pairs = []
+        self.document_batching = document_batching
         self.chosen_tuples = []
         self.relation_map = {}
         self.seen_token_spans = set()
@@ -25,47 +38,68 @@ class ExtractRelations:
     
     def extract_entities_spacy(self, raw_text):
         """Process webpage text and extract sentences using spaCy."""
-        doc = nlp(raw_text)
+        doc = self.annotate(raw_text)
+        return self.classify(self.create_candidate_pairs(doc))
 
+    def annotate(self, raw_text):
+        """Run spaCy over the webpage text."""
         print("Annotating the webpage using spacy...")
+        return get_nlp()(raw_text)
 
+    def create_candidate_pairs(self, doc):
+        """Return, for every sentence, the entity pairs whose types fit the relation."""
         sentences = list(doc.sents)
-        extracted_annotations = 0
 
-        print(f"Extracted {len(list(doc.sents))} sentences. Processing each sentence one by one to check for presence of right pair of named entity types; if so, will run the second pipeline ...")
-        
-        for idx, sentence in enumerate(sentences):
-            if (idx + 1) % 5 == 0:
-                print(f"\n\tProcessed {idx + 1} / {len(sentences)} sentences")
+        print(f"Extracted {len(sentences)} sentences. Processing each sentence one by one to check for presence of right pair of named entity types; if so, will run the second pipeline ...")
 
-            ents = get_entities(sentence, self.entities_of_interest)
-            
+        sentence_pairs = []
+        for sentence in sentences:
+            pairs = []
             # create entity pairs
             sentence_entity_pairs = create_entity_pairs(sentence, self.entities_of_interest)
-            # Inside your class method
             for ep in sentence_entity_pairs:
                 subj, obj = ep[1], ep[2]
 
                 if self.relation == 1 and subj[1] == "PERSON" and obj[1] == "ORGANIZATION":
                     # Schools_Attended
-                    self.candidate_pairs.append({"tokens": ep[0], "subj": subj, "obj": obj})
+                    pairs.append({"tokens": ep[0], "subj": subj, "obj": obj})
                 
                 elif self.relation == 2 and subj[1] == "PERSON" and obj[1] == "ORGANIZATION":
                     # Work_For
-                    self.candidate_pairs.append({"tokens": ep[0], "subj": subj, "obj": obj})
+                    pairs.append({"tokens": ep[0], "subj": subj, "obj": obj})
                 
                 elif self.relation == 3 and subj[1] == "PERSON" and obj[1] in ["LOCATION", "CITY", "STATE_OR_PROVINCE", "COUNTRY"]:
                     # Live_In
-                    self.candidate_pairs.append({"tokens": ep[0], "subj": subj, "obj": obj})
+                    pairs.append({"tokens": ep[0], "subj": subj, "obj": obj})
                 
                 elif self.relation == 4 and subj[1] == "ORGANIZATION" and obj[1] == "PERSON":
                     # Top_Member_Employees
-                    self.candidate_pairs.append({"tokens": ep[0], "subj": subj, "obj": obj})
-            
-            if len(self.candidate_pairs) == 0:
+                    pairs.append({"tokens": ep[0], "subj": subj, "obj": obj})
+            sentence_pairs.append(pairs)
+        return sentence_pairs
+
+    def classify(self, sentence_pairs):
+        """Run SpanBERT over the candidate pairs of each sentence and keep the confident ones.
+
+        The pairs of the whole page go through SpanBERT in a single batched pass, or sentence
+        by sentence when `document_batching` is off.
+        """
+        extracted_annotations = 0
+
+        sentence_predictions = None
+        if self.document_batching:
+            sentence_predictions = predict_sentence_pairs(sentence_pairs)
+
+        for idx, pairs in enumerate(sentence_pairs):
+            if (idx + 1) % 5 == 0:
+                print(f"\n\tProcessed {idx + 1} / {len(sentence_pairs)} sentences")
+
+            if len(pairs) == 0:
                 continue
+            if sentence_predictions is not None:
+                relation_predictions = sentence_predictions[idx]
             else:
-                relation_predictions = spanbert.predict(self.candidate_pairs)  # get predictions: list of (relation, confidence) pairs
+                relation_predictions = get_spanbert().predict(pairs)  # get predictions: list of (relation, confidence) pairs
 
             relation_mapping = {
                 1: ("per:schools_attended", "PERSON", "ORGANIZATION"),
@@ -76,7 +110,7 @@ class ExtractRelations:
 
             expected_label, expected_subj_type, expected_obj_type = relation_mapping[self.relation]
 
-            for ex, pred in zip(self.candidate_pairs, relation_predictions):
+            for ex, pred in zip(pairs, relation_predictions):
                 relation_label, confidence = pred
                 subj, obj = ex['subj'], ex['obj']
                 tokens = ex['tokens']
@@ -112,6 +146,6 @@ class ExtractRelations:
                         print("\t\tConfidence is lower than threshold confidence. Ignoring this.")
                         print("\t\t==========")
 
-        print(f"\n\tExtracted annotations for  {extracted_annotations}  out of total  {len(sentences)}  sentences")
+        print(f"\n\tExtracted annotations for  {extracted_annotations}  out of total  {len(sentence_pairs)}  sentences")
         print(f"\n\tRelations extracted from this website: {len(self.chosen_tuples)} (Overall: {len(self.relation_map)})")
         return self.chosen_tuples
\ No newline at end of file
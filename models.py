@@ -0,0 +1,92 @@
+import logging
+import threading
+import time
+
+# Options for the shared SpanBERT instance; change them before its first use.
+SPANBERT_DIR = "./pretrained_spanbert"
+SPANBERT_OPTIONS = {}
+# Directory of a span-pair model trained with distill_span_pair.py; when set, it is served
+# instead of SpanBERT.
+SPAN_PAIR_DIR = None
+SPACY_MODEL = "en_core_web_lg"
+
+
+class ModelRegistry:
+    """Loads every registered model the first time it is requested and shares it afterwards.
+
+    Safe to use from several threads: a model is loaded exactly once, and threads asking for a
+    model that is still loading wait for it instead of loading a second copy.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._models = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+        # name -> (perf_counter when loading started, perf_counter when it finished)
+        self.load_times = {}
+
+    def register(self, name, factory):
+        with self._lock:
+            self._factories[name] = factory
+            self._locks[name] = threading.Lock()
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def get(self, name):
+        if name in self._models:
+            return self._models[name]
+        if name not in self._factories:
+            raise KeyError(f"No model registered under '{name}'.")
+        with self._locks[name]:
+            if name not in self._models:
+                started = time.perf_counter()
+                self._models[name] = self._factories[name]()
+                self.load_times[name] = (started, time.perf_counter())
+        return self._models[name]
+
+    def preload(self, name):
+        """Start loading a model in a background thread; `get` then waits for it."""
+        def load():
+            try:
+                self.get(name)
+            except Exception as e:
+                # `get` will retry, and raise, when the model is actually needed.
+                logging.warning(f"Background loading of '{name}' failed: {e}")
+
+        thread = threading.Thread(target=load, name=f"load-{name}", daemon=True)
+        thread.start()
+        return thread
+
+
+def _load_spacy():
+    import spacy
+    return spacy.load(SPACY_MODEL)
+
+
+def _load_spanbert():
+    if SPAN_PAIR_DIR is not None:
+        from span_pair import SpanPairBERT
+        spanbert = SpanPairBERT(SPAN_PAIR_DIR)
+        spanbert.warmup()
+        return spanbert
+    from spanbert import SpanBERT
+    spanbert = SpanBERT(SPANBERT_DIR, **SPANBERT_OPTIONS)
+    spanbert.warmup()
+    return spanbert
+
+
+registry = ModelRegistry()
+registry.register("spacy", _load_spacy)
+registry.register("spanbert", _load_spanbert)
+
+
+def get_nlp():
+    """The shared spaCy pipeline, loaded on first use."""
+    return registry.get("spacy")
+
+
+def get_spanbert():
+    """The shared SpanBERT classifier, loaded on first use."""
+    return registry.get("spanbert")
@@ -0,0 +1,239 @@
+import atexit
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+INDEX_NAME = "index.json"
+
+
+class PageCache:
+    """On-disk cache of downloaded pages and their cleaned text.
+
+    Raw HTML and cleaned text are stored gzip-compressed under the SHA-256 of the HTML, so
+    URLs serving the same page share one copy. The index maps every URL to its content hash,
+    its `ETag`/`Last-Modified` validators and when it was fetched and last used.
+
+    A page fetched less than `ttl` seconds ago is served without touching the network; an
+    older one is revalidated with `If-None-Match`/`If-Modified-Since`, and its cached text
+    is reused when the server answers 304 or sends the same HTML again. Once the stored
+    files exceed `max_bytes`, the least recently used URLs are evicted.
+
+    The index, last-use times included, is written at most once every `save_interval` seconds
+    and at exit (`flush`) rather than on every page. Files a crash left out of the index are
+    deleted the next time the cache is opened.
+    """
+
+    def __init__(self, cache_dir, ttl=24 * 3600, max_bytes=256 * 1024 * 1024, timeout=30, session=None,
+                 read=None, save_interval=5.0):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.session = session or requests.Session()
+        # Reads the HTML of a response requested with stream=True.
+        self.read = read or (lambda response: response.text)
+        self.save_interval = save_interval
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, INDEX_NAME)
+        # url -> {"digest", "etag", "last_modified", "fetched_at", "used_at"}; file name -> size.
+        self._pages = {}
+        self._files = {}
+        if os.path.exists(self._index_path):
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as reader:
+                    index = json.load(reader)
+                self._pages, self._files = index["pages"], index["files"]
+            except (ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable page cache index {self._index_path}: {e}")
+        self._remove_orphans()
+        atexit.register(self.flush)
+
+    def fetch(self, url, variant="text"):
+        """Returns (html, text) for `url`: the cached cleaned text (`variant`) when the page
+        has not changed, with html None; otherwise the HTML, from the server or the cache,
+        with text None. Store the text cleaned from it with `store_text`.
+
+        Raises `requests.RequestException` when the page cannot be downloaded.
+        """
+        page = self.cached(url, variant)
+        if page is not None:
+            return page
+        response = self.session.get(url, timeout=self.timeout, headers=self.validators(url), stream=True)
+        if response.status_code == 304:
+            response.close()
+            page = self.revalidated(url, variant)
+            if page is not None:
+                return page
+            # The cached files are gone; download the page again without validators.
+            response = self.session.get(url, timeout=self.timeout, stream=True)
+        response.raise_for_status()
+        return self.store_html(url, self.read(response), response.headers, variant)
+
+    # The steps of `fetch`, for callers doing their own HTTP requests.
+
+    def cached(self, url, variant="text"):
+        """The (html, text) of a page fetched less than `ttl` seconds ago, or None."""
+        with self._lock:
+            entry = self._pages.get(url)
+            if entry is not None and time.time() - entry["fetched_at"] < self.ttl:
+                page = self._cached_page(entry, variant)
+                self._changed()
+                return page
+        return None
+
+    def validators(self, url):
+        """The conditional request headers for `url`."""
+        headers = {}
+        with self._lock:
+            entry = self._pages.get(url)
+            if entry is not None:
+                if entry.get("etag"):
+                    headers["If-None-Match"] = entry["etag"]
+                if entry.get("last_modified"):
+                    headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def revalidated(self, url, variant="text"):
+        """The (html, text) of `url` after the server answered 304, or None when the cache no
+        longer has it and the page must be downloaded again."""
+        with self._lock:
+            entry = self._pages.get(url)
+            if entry is None:
+                return None
+            entry["fetched_at"] = time.time()
+            page = self._cached_page(entry, variant)
+            self._changed()
+            return page
+
+    def store_html(self, url, html, headers, variant="text"):
+        """Records a downloaded page with the validators from its response `headers`. Returns
+        (None, text) when the same HTML was cleaned before, otherwise (html, None)."""
+        digest = self._digest(html)
+        with self._lock:
+            old_entry = self._pages.get(url)
+            self._pages[url] = {
+                "digest": digest,
+                "etag": headers.get("ETag"),
+                "last_modified": headers.get("Last-Modified"),
+                "fetched_at": time.time(),
+                "used_at": time.time(),
+            }
+            if old_entry is not None and old_entry["digest"] != digest:
+                self._release(old_entry["digest"])
+            text = self._read(f"{digest}.{variant}.gz")
+            if text is not None:
+                self._changed()
+                return None, text
+            if f"{digest}.html.gz" not in self._files:
+                self._write(f"{digest}.html.gz", html)
+                self._evict()
+            self._changed()
+            return html, None
+
+    def store_text(self, url, html, text, variant="text"):
+        """Caches `text`, cleaned from the `html` returned by `fetch`."""
+        digest = self._digest(html)
+        with self._lock:
+            entry = self._pages.get(url)
+            if entry is None or entry["digest"] != digest:
+                # Evicted, or replaced by a newer download, in the meantime.
+                return
+            self._write(f"{digest}.{variant}.gz", text)
+            self._evict()
+            self._changed()
+
+    def flush(self):
+        """Writes the index if it has changed since it was last written."""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+
+    def _cached_page(self, entry, variant):
+        entry["used_at"] = time.time()
+        text = self._read(f"{entry['digest']}.{variant}.gz")
+        if text is not None:
+            return None, text
+        html = self._read(f"{entry['digest']}.html.gz")
+        if html is not None:
+            return html, None
+        return None
+
+    @staticmethod
+    def _digest(html):
+        return hashlib.sha256(html.encode("utf-8")).hexdigest()
+
+    def _read(self, name):
+        if name not in self._files:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir, name), "rb") as reader:
+                return gzip.decompress(reader.read()).decode("utf-8")
+        except OSError:
+            del self._files[name]
+            return None
+
+    def _write(self, name, content):
+        data = gzip.compress(content.encode("utf-8"))
+        path = os.path.join(self.cache_dir, name)
+        with open(path + ".tmp", "wb") as writer:
+            writer.write(data)
+        os.replace(path + ".tmp", path)
+        self._files[name] = len(data)
+
+    def _evict(self):
+        """Drops the least recently used URLs, and the files no other URL refers to, until the
+        cache fits in `max_bytes`."""
+        total = sum(self._files.values())
+        if total <= self.max_bytes:
+            return
+        by_use = sorted(self._pages, key=lambda url: self._pages[url]["used_at"])
+        for url in by_use:
+            if total <= self.max_bytes:
+                break
+            total -= self._release(self._pages.pop(url)["digest"])
+
+    def _release(self, digest):
+        """Deletes the files of `digest` unless another URL still refers to them; returns
+        the number of bytes freed."""
+        if any(entry["digest"] == digest for entry in self._pages.values()):
+            return 0
+        freed = 0
+        for name in [name for name in self._files if name.startswith(digest + ".")]:
+            freed += self._files.pop(name)
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+        return freed
+
+    def _remove_orphans(self):
+        for name in os.listdir(self.cache_dir):
+            # Only the names `_write` creates, in case the directory holds anything else.
+            if name.endswith((".gz", ".gz.tmp")) and name not in self._files:
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def _changed(self):
+        """Marks the index as modified, writing it if `save_interval` has passed since the last write."""
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= self.save_interval:
+            self._save_index()
+
+    def _save_index(self):
+        tmp_path = self._index_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as writer:
+            json.dump({"pages": self._pages, "files": self._files}, writer)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+        self._saved_at = time.monotonic()
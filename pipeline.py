@@ -0,0 +1,204 @@
+import logging
+import queue
+import sys
+import threading
+
+_DONE = object()
+
+
+class _PipelineOutput:
+    """Stands in for sys.stdout while a pipeline runs, so the messages of pages handled in
+    parallel do not interleave.
+
+    Every thread's writes are buffered apart: what a worker prints while handling an item is
+    written out in one piece once the item is done, and other threads' output line by line.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._buffers = []
+
+    def _buffer(self):
+        if not hasattr(self._local, "parts"):
+            self._local.parts = []
+            self._local.in_item = False
+            with self._lock:
+                self._buffers.append(self._local.parts)
+        return self._local.parts
+
+    def write(self, text):
+        parts = self._buffer()
+        parts.append(text)
+        if not self._local.in_item and "\n" in text:
+            self._emit(complete_lines=True)
+        return len(text)
+
+    def flush(self):
+        if not getattr(self._local, "in_item", False):
+            self._emit(complete_lines=False)
+
+    def begin_item(self):
+        self._emit(complete_lines=False)
+        self._local.in_item = True
+
+    def end_item(self):
+        self._local.in_item = False
+        self._emit(complete_lines=False)
+
+    def close(self):
+        """Writes out what any thread left without a final newline."""
+        with self._lock:
+            for parts in self._buffers:
+                self.stream.write("".join(parts))
+                parts.clear()
+            self.stream.flush()
+
+    def _emit(self, complete_lines):
+        parts = self._buffer()
+        text = "".join(parts)
+        parts.clear()
+        if complete_lines:
+            end = text.rfind("\n") + 1
+            text, rest = text[:end], text[end:]
+            if rest:
+                parts.append(rest)
+        if text:
+            with self._lock:
+                self.stream.write(text)
+                self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class Stage:
+    """One step of a Pipeline: `fn` is applied to every item by `workers` threads.
+
+    Returning None from `fn` drops the item; anything else is handed to the next stage.
+    Exceptions of the `item_errors` types only drop the item they were raised on (e.g. a
+    page that cannot be parsed); any other exception is treated as persistent, such as a
+    model that failed to load, and stops the whole pipeline.
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=4, item_errors=()):
+        if workers < 1:
+            raise ValueError(f"Stage '{name}' needs at least one worker, got {workers}.")
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size
+        self.item_errors = item_errors
+
+
+class Pipeline:
+    """Runs items through a chain of stages connected by bounded queues.
+
+    Every stage has its own worker threads, so network-bound stages (fetching) overlap
+    with CPU-bound ones (NER, inference). A full queue blocks the stage feeding it,
+    which keeps the number of pages in flight bounded.
+    """
+
+    def __init__(self, stages):
+        if not stages:
+            raise ValueError("A pipeline needs at least one stage.")
+        self.stages = stages
+        self._stop = threading.Event()
+        self._error = None
+
+    def stop(self):
+        """Ask every stage to drop the items it has not started yet."""
+        self._stop.set()
+
+    def _fail(self, error):
+        if self._error is None:
+            self._error = error
+        self._stop.set()
+
+    def _feed(self, items, out_queue, consumers):
+        try:
+            for item in items:
+                if self._stop.is_set():
+                    break
+                out_queue.put(item)
+        except Exception as e:
+            logging.exception("Reading the pipeline input failed; stopping the pipeline")
+            self._fail(e)
+        finally:
+            for _ in range(consumers):
+                out_queue.put(_DONE)
+
+    def _work(self, stage, in_queue, out_queue, consumers, remaining, lock, output):
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            if self._stop.is_set():
+                continue
+            output.begin_item()
+            try:
+                result = stage.fn(item)
+            except stage.item_errors:
+                logging.exception(f"Stage '{stage.name}' failed on an item; skipping it")
+                continue
+            except Exception as e:
+                logging.exception(f"Stage '{stage.name}' failed; stopping the pipeline")
+                self._fail(e)
+                continue
+            finally:
+                output.end_item()
+            if result is not None:
+                out_queue.put(result)
+
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(consumers):
+                out_queue.put(_DONE)
+
+    def run(self, items):
+        """Feed `items` through every stage and yield the outputs of the last stage as they complete.
+
+        Re-raises the first persistent error of any stage (see `Stage`) once the workers stopped.
+        """
+        self._stop.clear()
+        self._error = None
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages]
+        queues.append(queue.Queue())
+        output = _PipelineOutput(sys.stdout)
+        sys.stdout = output
+
+        threads = [threading.Thread(target=self._feed,
+                                    args=(items, queues[0], self.stages[0].workers),
+                                    daemon=True)]
+        for i, stage in enumerate(self.stages):
+            consumers = self.stages[i + 1].workers if i + 1 < len(self.stages) else 1
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(stage, queues[i], queues[i + 1], consumers, remaining, lock,
+                                                      output),
+                                                name=f"{stage.name}-worker",
+                                                daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                result = queues[-1].get()
+                if result is _DONE:
+                    break
+                yield result
+        finally:
+            # The caller may stop early; drain so no worker stays blocked on a full queue.
+            self._stop.set()
+            while result is not _DONE:
+                result = queues[-1].get()
+            for thread in threads:
+                thread.join()
+            output.close()
+            sys.stdout = output.stream
+        if self._error is not None:
+            raise self._error
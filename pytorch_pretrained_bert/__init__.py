@@ -6,8 +6,13 @@ from .modeling import (BertConfig, BertModel, BertForPreTraining,
                        BertForMaskedLM, BertForNextSentencePrediction,
                        BertForSequenceClassification, BertForMultipleChoice,
                        BertForTokenClassification, BertForQuestionAnswering,
+                       BertForSpanPairClassification,
                        load_tf_weights_in_bert)
 
 from .optimization import BertAdam
 
+from .quantization import quantize_dynamic_bert, save_quantized, load_quantized, source_fingerprint
+
+from .mmap_weights import SAFE_WEIGHTS_NAME, convert_checkpoint, load_flat, save_flat
+
 from .file_utils import PYTORCH_PRETRAINED_BERT_CACHE, cached_path, WEIGHTS_NAME, CONFIG_NAME
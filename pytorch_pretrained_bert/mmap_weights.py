@@ -0,0 +1,123 @@
+# coding=utf-8
+"""Flat, memory-mappable weight files in the safetensors layout.
+
+A file is an 8-byte little-endian header length, a JSON header mapping every tensor name to
+its dtype, shape and byte range, and then the raw tensor bytes. Loading maps the file into
+memory and builds tensors directly on top of the mapping, so nothing is read or copied up
+front and several processes loading the same file share its pages through the page cache.
+"""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import mmap
+import os
+import struct
+from collections import OrderedDict
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+SAFE_WEIGHTS_NAME = "model.safetensors"
+
+_DTYPES = OrderedDict([
+    ("F64", torch.float64),
+    ("F32", torch.float32),
+    ("F16", torch.float16),
+    ("BF16", torch.bfloat16),
+    ("I64", torch.int64),
+    ("I32", torch.int32),
+    ("I16", torch.int16),
+    ("I8", torch.int8),
+    ("U8", torch.uint8),
+    ("BOOL", torch.bool),
+])
+_DTYPE_NAMES = {dtype: name for name, dtype in _DTYPES.items()}
+
+
+def rename_state_dict_keys(state_dict):
+    """ Applies the key renaming `BertPreTrainedModel.from_pretrained` does on old checkpoints
+        (TF-style `gamma`/`beta`, `decoder.` prefix).
+    """
+    renamed = OrderedDict()
+    for key, value in state_dict.items():
+        new_key = key[8:] if key.startswith("decoder.") else key
+        if 'gamma' in new_key:
+            new_key = new_key.replace('gamma', 'weight')
+        if 'beta' in new_key:
+            new_key = new_key.replace('beta', 'bias')
+        renamed[new_key] = value
+    return renamed
+
+
+def save_flat(state_dict, path, dtype=None, metadata=None):
+    """ Writes `state_dict` to `path`; floating point tensors are cast to `dtype` if given. """
+    header = OrderedDict()
+    tensors = []
+    offset = 0
+    for name, tensor in state_dict.items():
+        tensor = tensor.detach().cpu()
+        if dtype is not None and tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensor = tensor.contiguous()
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": _DTYPE_NAMES[tensor.dtype], "shape": list(tensor.shape),
+                        "data_offsets": [offset, offset + num_bytes]}
+        tensors.append(tensor)
+        offset += num_bytes
+    if metadata:
+        header["__metadata__"] = {str(k): str(v) for k, v in metadata.items()}
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    # Pad the header so the tensor data starts 8-byte aligned.
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as writer:
+        writer.write(struct.pack("<Q", len(header_bytes)))
+        writer.write(header_bytes)
+        for tensor in tensors:
+            if tensor.numel():
+                writer.write(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_flat(path):
+    """ Memory-maps a file written by `save_flat` and returns its tensors as an OrderedDict.
+
+        The tensors are views of a private copy-on-write mapping: reading them shares the
+        page cache, and writing to one only copies the touched pages.
+    """
+    with open(path, "rb") as reader:
+        header_length, = struct.unpack("<Q", reader.read(8))
+        header = json.loads(reader.read(header_length).decode("utf-8"))
+        buffer = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_COPY)
+    data_start = 8 + header_length
+    header.pop("__metadata__", None)
+
+    state_dict = OrderedDict()
+    for name, info in header.items():
+        dtype = _DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        if end == start:
+            tensor = torch.empty(info["shape"], dtype=dtype)
+        else:
+            count = (end - start) // torch.empty(0, dtype=dtype).element_size()
+            tensor = torch.frombuffer(buffer, dtype=dtype, count=count,
+                                      offset=data_start + start).view(info["shape"])
+        state_dict[name] = tensor
+    return state_dict
+
+
+def convert_checkpoint(weights_path, output_path, dtype=None):
+    """ One-time conversion of a `pytorch_model.bin` checkpoint to a flat file with its keys
+        already renamed, optionally cast to fp16/bf16.
+    """
+    state_dict = torch.load(weights_path, map_location='cpu')
+    state_dict = rename_state_dict_keys(state_dict)
+    # Tied weights share storage; write each of them on its own.
+    save_flat(OrderedDict((k, v.clone()) for k, v in state_dict.items()), output_path, dtype=dtype,
+              metadata={"format": "pt", "source": os.path.basename(weights_path)})
+    logger.info("Converted {} to {}".format(weights_path, output_path))
+    return output_path
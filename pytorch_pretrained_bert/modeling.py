@@ -18,7 +18,9 @@
 
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import contextlib
 import copy
+import inspect
 import json
 import logging
 import math
@@ -34,6 +36,7 @@ from torch import nn
 from torch.nn import CrossEntropyLoss
 
 from .file_utils import cached_path, WEIGHTS_NAME, CONFIG_NAME
+from .mmap_weights import SAFE_WEIGHTS_NAME, load_flat
 
 logger = logging.getLogger(__name__)
 
@@ -49,6 +52,19 @@ PRETRAINED_MODEL_ARCHIVE_MAP = {
 BERT_CONFIG_NAME = 'bert_config.json'
 TF_WEIGHTS_NAME = 'model.ckpt'
 
+# Building on the meta device and assigning checkpoint tensors needs torch>=2.1.
+_SUPPORTS_ASSIGN = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+
+
+@contextlib.contextmanager
+def _skeleton_construction():
+    """ Builds modules on the meta device: parameters get a shape and dtype but no storage, and
+        the initializers run by the torch.nn constructors do no work on them.
+    """
+    with torch.device('meta'):
+        yield
+
+
 def load_tf_weights_in_bert(model, tf_checkpoint_path):
     """ Load tf checkpoints in a pytorch model
     """
@@ -258,10 +274,11 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -275,6 +292,25 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 
+class UnpaddedBatch(object):
+    """ Positions of the real tokens of a padded [batch_size, seq_length] batch, used to run the
+        position-wise layers of the encoder on the real tokens only.
+    """
+    def __init__(self, attention_mask):
+        self.batch_size, self.seq_length = attention_mask.shape
+        self.indices = attention_mask.reshape(-1).nonzero().squeeze(1)
+
+    def unpad(self, x):
+        """ [batch_size, seq_length, dim] -> [total_tokens, dim] """
+        return x.reshape(-1, x.size(-1)).index_select(0, self.indices)
+
+    def pad(self, x):
+        """ [total_tokens, dim] -> [batch_size, seq_length, dim], zeros at padded positions """
+        padded = x.new_zeros(self.batch_size * self.seq_length, x.size(-1))
+        padded.index_copy_(0, self.indices, x)
+        return padded.view(self.batch_size, self.seq_length, x.size(-1))
+
+
 class BertSelfAttention(nn.Module):
     def __init__(self, config):
         super(BertSelfAttention, self).__init__()
@@ -292,15 +328,78 @@ class BertSelfAttention(nn.Module):
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)
 
+        # Inference fast path, see `enable_fast_attention`. The packed projection is a
+        # non-persistent buffer: checkpoints keep the separate query/key/value weights.
+        self.fast_attention = False
+        self.register_buffer('qkv_weight', None, persistent=False)
+        self.register_buffer('qkv_bias', None, persistent=False)
+
     def transpose_for_scores(self, x):
         new_x_shape = x.size()[:-1] + (self.num_attention_heads, self.attention_head_size)
         x = x.view(*new_x_shape)
         return x.permute(0, 2, 1, 3)
 
-    def forward(self, hidden_states, attention_mask):
+    def enable_fast_attention(self, enabled=True, pack=True):
+        """ In eval mode, compute attention with `scaled_dot_product_attention` and, with `pack`
+            and when the projections are plain nn.Linear layers, a single packed query/key/value
+            projection.
+
+            Packing copies the query/key/value parameters into one weight and makes them views of
+            it, so in-place updates to them are seen by the fast path; call this again after
+            replacing or moving them.
+        """
+        self.fast_attention = enabled
+        self.qkv_weight = None
+        self.qkv_bias = None
+        projections = (self.query, self.key, self.value)
+        if not enabled or not pack or any(type(p) is not nn.Linear for p in projections):
+            return
+        with torch.no_grad():
+            self.qkv_weight = torch.cat([p.weight for p in projections], dim=0)
+            self.qkv_bias = torch.cat([p.bias for p in projections], dim=0)
+            for i, p in enumerate(projections):
+                p.weight.data = self.qkv_weight[i * self.all_head_size:(i + 1) * self.all_head_size]
+                p.bias.data = self.qkv_bias[i * self.all_head_size:(i + 1) * self.all_head_size]
+
+    def _fast_forward(self, hidden_states, attention_mask, unpadded=None):
+        if self.qkv_weight is not None:
+            mixed_layers = nn.functional.linear(hidden_states, self.qkv_weight, self.qkv_bias)
+            if unpadded is not None:
+                mixed_layers = unpadded.pad(mixed_layers)
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = mixed_layers.split(self.all_head_size, dim=-1)
+        else:
+            mixed_query_layer = self.query(hidden_states)
+            mixed_key_layer = self.key(hidden_states)
+            mixed_value_layer = self.value(hidden_states)
+            if unpadded is not None:
+                mixed_query_layer, mixed_key_layer, mixed_value_layer = (
+                    unpadded.pad(x) for x in (mixed_query_layer, mixed_key_layer, mixed_value_layer))
+        # Unlike the exact path, raw scores are not clamped to +-10000 before the mask is added.
+        context_layer = nn.functional.scaled_dot_product_attention(
+            self.transpose_for_scores(mixed_query_layer),
+            self.transpose_for_scores(mixed_key_layer),
+            self.transpose_for_scores(mixed_value_layer),
+            attn_mask=attention_mask)
+        context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+        new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
+        context_layer = context_layer.view(*new_context_layer_shape)
+        if unpadded is not None:
+            context_layer = unpadded.unpad(context_layer)
+        return context_layer
+
+    def forward(self, hidden_states, attention_mask, unpadded=None):
+        """ With `unpadded` (an `UnpaddedBatch`), `hidden_states` holds only the real tokens of
+            the batch, [total_tokens, hidden_size]; they are scattered back to the padded layout
+            for the attention itself and the result is packed again.
+        """
+        if self.fast_attention and not self.training:
+            return self._fast_forward(hidden_states, attention_mask, unpadded)
         mixed_query_layer = self.query(hidden_states)
         mixed_key_layer = self.key(hidden_states)
         mixed_value_layer = self.value(hidden_states)
+        if unpadded is not None:
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = (
+                unpadded.pad(x) for x in (mixed_query_layer, mixed_key_layer, mixed_value_layer))
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_for_scores(mixed_key_layer)
@@ -326,6 +425,8 @@ class BertSelfAttention(nn.Module):
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
+        if unpadded is not None:
+            context_layer = unpadded.unpad(context_layer)
         return context_layer
 
 
@@ -349,8 +450,8 @@ class BertAttention(nn.Module):
         self.self = BertSelfAttention(config)
         self.output = BertSelfOutput(config)
 
-    def forward(self, input_tensor, attention_mask):
-        self_output = self.self(input_tensor, attention_mask)
+    def forward(self, input_tensor, attention_mask, unpadded=None):
+        self_output = self.self(input_tensor, attention_mask, unpadded)
         attention_output = self.output(self_output, input_tensor)
         return attention_output
 
@@ -391,8 +492,8 @@ class BertLayer(nn.Module):
         self.intermediate = BertIntermediate(config)
         self.output = BertOutput(config)
 
-    def forward(self, hidden_states, attention_mask):
-        attention_output = self.attention(hidden_states, attention_mask)
+    def forward(self, hidden_states, attention_mask, unpadded=None):
+        attention_output = self.attention(hidden_states, attention_mask, unpadded)
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
         return layer_output
@@ -404,10 +505,10 @@ class BertEncoder(nn.Module):
         layer = BertLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, unpadded=None):
         all_encoder_layers = []
         for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+            hidden_states = layer_module(hidden_states, attention_mask, unpadded)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
         if not output_all_encoded_layers:
@@ -512,10 +613,16 @@ class BertPreTrainedModel(nn.Module):
                     self.__class__.__name__, self.__class__.__name__
                 ))
         self.config = config
+        # name -> data_ptr of the parameters `from_pretrained` left as views of a memory-mapped
+        # weight file; a parameter that has since been moved or cast has another data_ptr.
+        self._mapped_parameters = {}
 
     def init_bert_weights(self, module):
         """ Initialize the weights.
         """
+        if any(p.is_meta for p in module.parameters(recurse=False)):
+            # A skeleton built by from_pretrained: the checkpoint provides the values.
+            return
         if isinstance(module, (nn.Linear, nn.Embedding)):
             # Slightly different from the TF version which uses truncated_normal for initialization
             # cf https://github.com/pytorch/pytorch/pull/5617
@@ -526,6 +633,52 @@ class BertPreTrainedModel(nn.Module):
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
+    @classmethod
+    def build_uninitialized(cls, config, *inputs, **kwargs):
+        """ Builds the model with allocated but uninitialized parameters, for callers that load
+            every weight themselves right afterwards.
+        """
+        if not _SUPPORTS_ASSIGN:
+            return cls(config, *inputs, **kwargs)
+        with _skeleton_construction():
+            model = cls(config, *inputs, **kwargs)
+        return model.to_empty(device='cpu')
+
+    def enable_fast_attention(self, enabled=True):
+        """ Switches every attention layer to the packed-projection / `scaled_dot_product_attention`
+            inference path (see `BertSelfAttention.enable_fast_attention`). Call it after the
+            weights are loaded, moved and cast; the exact path is used in training mode.
+
+            Layers whose query/key/value weights are still memory-mapped from `model.safetensors`
+            keep the three projections: packing them would copy them out of the shared mapping.
+        """
+        for name, module in self.named_modules():
+            if isinstance(module, BertSelfAttention):
+                prefix = name + '.' if name else ''
+                pack = not any(self._is_memory_mapped(prefix + projection + '.weight')
+                               for projection in ('query', 'key', 'value'))
+                module.enable_fast_attention(enabled, pack=pack)
+        return self
+
+    def _is_memory_mapped(self, name):
+        """ Whether parameter `name` is still a view of the weight file `from_pretrained` mapped. """
+        pointer = self._mapped_parameters.get(name)
+        return pointer is not None and self.get_parameter(name).data_ptr() == pointer
+
+    def _materialize_missing_weights(self):
+        """ Allocates and initializes the parameters a meta-device model did not get from its
+            checkpoint (e.g. a new classification head).
+        """
+        for module in self.modules():
+            if not any(p.is_meta for p in module.parameters(recurse=False)):
+                continue
+            module.to_empty(device='cpu', recurse=False)
+            if isinstance(module, (nn.Linear, nn.Embedding, BertLayerNorm)):
+                self.init_bert_weights(module)
+            else:
+                for param in module.parameters(recurse=False):
+                    param.data.zero_()
+
     @classmethod
     def from_pretrained(cls, pretrained_model_name_or_path, state_dict=None, cache_dir=None,
                         from_tf=False, *inputs, **kwargs):
@@ -546,15 +699,23 @@ class BertPreTrainedModel(nn.Module):
                 - a path or url to a pretrained model archive containing:
                     . `bert_config.json` a configuration file for the model
                     . `pytorch_model.bin` a PyTorch dump of a BertForPreTraining instance
+                - a path to a pretrained model directory containing:
+                    . `bert_config.json` a configuration file for the model
+                    . `model.safetensors` weights converted by `mmap_weights.convert_checkpoint`,
+                      memory-mapped instead of read (used in place of `pytorch_model.bin`)
                 - a path or url to a pretrained model archive containing:
                     . `bert_config.json` a configuration file for the model
                     . `model.ckpt` a TensorFlow checkpoint
             from_tf: should we load the weights from a locally saved TensorFlow checkpoint
             cache_dir: an optional path to a folder in which the pre-trained models will be cached.
             state_dict: an optional state dictionnary (collections.OrderedDict object) to use instead of Google pre-trained models
+            torch_dtype: an optional floating point dtype for the parameters (default: torch's default dtype).
+                Checkpoint tensors stored in another dtype are cast, which copies them; pass the dtype
+                `model.safetensors` was converted to so its memory-mapped tensors are used as they are.
             *inputs, **kwargs: additional input for the specific Bert class
                 (ex: num_labels for BertForSequenceClassification)
         """
+        torch_dtype = kwargs.pop('torch_dtype', None)
         if pretrained_model_name_or_path in PRETRAINED_MODEL_ARCHIVE_MAP:
             archive_file = PRETRAINED_MODEL_ARCHIVE_MAP[pretrained_model_name_or_path]
         else:
@@ -596,11 +757,40 @@ class BertPreTrainedModel(nn.Module):
         if pretrained_model_name_or_path == 'bert-base-uncased-1024':
             config.max_position_embeddings = 1024
         logger.info("Model config {}".format(config))
-        # Instantiate model.
-        model = cls(config, *inputs, **kwargs)
+        # When we read the checkpoint ourselves, the model is built on the meta device, without
+        # allocating or initializing any parameter, and the checkpoint tensors are then assigned
+        # to it as its parameters. A state_dict passed in by the caller is copied as before.
+        assign = state_dict is None and not from_tf and _SUPPORTS_ASSIGN
+        mapped_pointers = set()
         if state_dict is None and not from_tf:
-            weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
-            state_dict = torch.load(weights_path, map_location='cpu')
+            safe_weights_path = os.path.join(serialization_dir, SAFE_WEIGHTS_NAME)
+            if os.path.exists(safe_weights_path):
+                # Written by `convert_checkpoint`: keys are already renamed and the tensors are
+                # views of the memory-mapped file, so assigning them copies nothing.
+                logger.info("loading memory-mapped weights from {}".format(safe_weights_path))
+                state_dict = load_flat(safe_weights_path)
+                mapped_pointers = {t.data_ptr() for t in state_dict.values() if t.numel()}
+            else:
+                weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
+                state_dict = torch.load(weights_path, map_location='cpu')
+        # Instantiate model.
+        if assign:
+            with _skeleton_construction():
+                model = cls(config, *inputs, **kwargs)
+            # Parameters take the dtype of the tensors assigned to them; keep the model's.
+            model_dtype = torch_dtype or torch.get_default_dtype()
+            stored_dtypes = set()
+            for key, value in state_dict.items():
+                if value.is_floating_point() and value.dtype != model_dtype:
+                    stored_dtypes.add(value.dtype)
+                    state_dict[key] = value.to(model_dtype)
+            if stored_dtypes:
+                logger.warning("Weights stored as {} are copied to {}; pass torch_dtype={} to "
+                               "load them without a copy".format(
+                                   ", ".join(str(d) for d in stored_dtypes), model_dtype,
+                                   next(iter(stored_dtypes))))
+        else:
+            model = cls(config, *inputs, **kwargs)
         if tempdir:
             # Clean up temp dir
             shutil.rmtree(tempdir)
@@ -634,6 +824,8 @@ class BertPreTrainedModel(nn.Module):
 
         def load(module, prefix=''):
             local_metadata = {} if metadata is None else metadata.get(prefix[:-1], {})
+            if assign:
+                local_metadata = dict(local_metadata, assign_to_params_buffers=True)
             module._load_from_state_dict(
                 state_dict, prefix, local_metadata, True, missing_keys, unexpected_keys, error_msgs)
             for name, child in module._modules.items():
@@ -643,6 +835,12 @@ class BertPreTrainedModel(nn.Module):
         if not hasattr(model, 'bert') and any(s.startswith('bert.') for s in state_dict.keys()):
             start_prefix = 'bert.'
         load(model, prefix=start_prefix)
+        if assign:
+            # Assigning replaced the decoder weight tied to the word embeddings; tie them again.
+            for module in model.modules():
+                if isinstance(module, BertLMPredictionHead):
+                    module.decoder.weight = model.bert.embeddings.word_embeddings.weight
+            model._materialize_missing_weights()
         if len(missing_keys) > 0:
             logger.info("Weights of {} not initialized from pretrained model: {}".format(
                 model.__class__.__name__, missing_keys))
@@ -652,6 +850,12 @@ class BertPreTrainedModel(nn.Module):
         if len(error_msgs) > 0:
             raise RuntimeError('Error(s) in loading state_dict for {}:\n\t{}'.format(
                                model.__class__.__name__, "\n\t".join(error_msgs)))
+        if torch_dtype is not None:
+            # Casts what was not loaded in that dtype (e.g. a new classification head).
+            model.to(torch_dtype)
+        if assign:
+            model._mapped_parameters = {name: p.data_ptr() for name, p in model.named_parameters()
+                                        if p.data_ptr() in mapped_pointers}
         return model
 
 
@@ -672,7 +876,14 @@ class BertModel(BertPreTrainedModel):
             selected in [0, 1]. It's a mask to be used if the input sequence length is smaller than the max
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
+            For packed sequences (several examples per row), a torch.LongTensor of shape
+            [batch_size, sequence_length, sequence_length]: block-diagonal, 1 where two tokens
+            belong to the same example.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `position_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length]; for packed
+            sequences, the positions restart at 0 for every example. Default: 0..sequence_length-1.
+        `cls_positions`: an optional torch.LongTensor of shape [num_examples, 2] with the (row, column)
+            of the `CLS` token of every packed example; `pooled_output` then has num_examples rows.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
@@ -705,19 +916,33 @@ class BertModel(BertPreTrainedModel):
         self.encoder = BertEncoder(config)
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
+        # Run the encoder on the real tokens only, see `enable_unpadded`.
+        self.unpadded = False
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
-        if attention_mask is None:
-            attention_mask = torch.ones_like(input_ids)
-        if token_type_ids is None:
-            token_type_ids = torch.zeros_like(input_ids)
-
-        # We create a 3D attention mask from a 2D tensor mask.
-        # Sizes are [batch_size, 1, 1, to_seq_length]
-        # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
-        # this attention mask is more simple than the triangular masking of causal attention
-        # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+    def enable_unpadded(self, enabled=True):
+        """ Packs the real tokens of every batch into one [total_tokens, hidden_size] tensor for
+            the dense and LayerNorm layers of the encoder, padding per sequence only inside the
+            attention. The encoded layers are returned padded, with zeros at padded positions.
+        """
+        self.unpadded = enabled
+        return self
+
+    def get_extended_attention_mask(self, attention_mask):
+        """ The additive attention mask of every layer, and the [batch_size, seq_length] mask of
+            the real tokens. """
+        if attention_mask.dim() == 3:
+            # Packed sequences: a [batch_size, from_seq_length, to_seq_length] block-diagonal mask,
+            # broadcast over the heads. The real tokens are the ones attending to themselves.
+            extended_attention_mask = attention_mask.unsqueeze(1)
+            token_mask = attention_mask.diagonal(dim1=1, dim2=2)
+        else:
+            # We create a 3D attention mask from a 2D tensor mask.
+            # Sizes are [batch_size, 1, 1, to_seq_length]
+            # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
+            # this attention mask is more simple than the triangular masking of causal attention
+            # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+            token_mask = attention_mask
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
@@ -726,12 +951,33 @@ class BertModel(BertPreTrainedModel):
         # effectively the same as removing these entirely.
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        return extended_attention_mask, token_mask
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
-        encoded_layers = self.encoder(embedding_output,
-                                      extended_attention_mask,
-                                      output_all_encoded_layers=output_all_encoded_layers)
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                position_ids=None, cls_positions=None):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+
+        extended_attention_mask, token_mask = self.get_extended_attention_mask(attention_mask)
+
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
+        if self.unpadded:
+            unpadded = UnpaddedBatch(token_mask)
+            encoded_layers = self.encoder(unpadded.unpad(embedding_output),
+                                          extended_attention_mask,
+                                          output_all_encoded_layers=output_all_encoded_layers,
+                                          unpadded=unpadded)
+            encoded_layers = [unpadded.pad(layer) for layer in encoded_layers]
+        else:
+            encoded_layers = self.encoder(embedding_output,
+                                          extended_attention_mask,
+                                          output_all_encoded_layers=output_all_encoded_layers)
         sequence_output = encoded_layers[-1]
+        if cls_positions is not None:
+            # One pooled output per packed example, read at its own [CLS] token.
+            sequence_output = sequence_output[cls_positions[:, 0], cls_positions[:, 1]].unsqueeze(1)
         pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
             encoded_layers = encoded_layers[-1]
@@ -954,6 +1200,8 @@ class BertForSequenceClassification(BertPreTrainedModel):
             a batch has varying length sentences.
         `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
             with indices selected in [0, ..., num_labels].
+        `position_ids`, `cls_positions`: for packed sequences, see `BertModel`. The batch then holds
+            num_examples examples, and `labels` and the logits have num_examples rows.
 
     Outputs:
         if `labels` is not `None`:
@@ -984,9 +1232,79 @@ class BertForSequenceClassification(BertPreTrainedModel):
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, num_labels)
         self.apply(self.init_bert_weights)
+        # Per-layer classifiers for early-exit inference, see `add_exit_heads`.
+        self.exit_heads = None
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
-        _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+    def add_exit_heads(self):
+        """ Adds a linear classifier over the [CLS] hidden state of every encoder layer but the
+            last, used by `forward_early_exit`. The heads are trained separately, against the
+            final classifier (see `exit_head_logits`), and saved apart from the model weights.
+        """
+        heads = [nn.Linear(self.config.hidden_size, self.num_labels)
+                 for _ in range(self.config.num_hidden_layers - 1)]
+        for head in heads:
+            self.init_bert_weights(head)
+        self.exit_heads = nn.ModuleList(heads)
+        return self.exit_heads
+
+    def exit_head_logits(self, encoded_layers):
+        """ The logits of every exit head, from the output of `BertModel` with
+            `output_all_encoded_layers=True`. """
+        return [head(layer[:, 0]) for head, layer in zip(self.exit_heads, encoded_layers)]
+
+    def forward_early_exit(self, input_ids, token_type_ids=None, attention_mask=None, exit_threshold=0.9):
+        """ Inference that stops early for confident rows. After every layer but the last, the
+            rows whose exit head gives a label a probability of at least `exit_threshold` take
+            that head's logits and leave the batch; the other rows go on as a smaller batch.
+
+            Returns the logits [batch_size, num_labels] and the number of layers run for every row.
+        """
+        bert = self.bert
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if attention_mask.dim() != 2:
+            raise ValueError("Early exit does not support packed sequences.")
+        extended_attention_mask, token_mask = bert.get_extended_attention_mask(attention_mask)
+        hidden_states = bert.embeddings(input_ids, token_type_ids)
+        num_layers = len(bert.encoder.layer)
+        logits = hidden_states.new_zeros(input_ids.size(0), self.num_labels)
+        layers_run = torch.full((input_ids.size(0),), num_layers, dtype=torch.long, device=input_ids.device)
+        active = torch.arange(input_ids.size(0), device=input_ids.device)
+        unpadded = UnpaddedBatch(token_mask) if bert.unpadded else None
+
+        for i, layer_module in enumerate(bert.encoder.layer):
+            if unpadded is not None:
+                hidden_states = unpadded.pad(
+                    layer_module(unpadded.unpad(hidden_states), extended_attention_mask, unpadded))
+            else:
+                hidden_states = layer_module(hidden_states, extended_attention_mask)
+            if i == num_layers - 1:
+                break
+            exit_logits = self.exit_heads[i](hidden_states[:, 0])
+            done = torch.softmax(exit_logits.float(), dim=-1).max(dim=-1)[0] >= exit_threshold
+            if not done.any():
+                continue
+            logits[active[done]] = exit_logits[done].to(logits.dtype)
+            layers_run[active[done]] = i + 1
+            keep = ~done
+            active = active[keep]
+            if len(active) == 0:
+                return logits, layers_run
+            # Drop the rows that exited, and the padding none of the remaining rows needs.
+            token_mask = token_mask[keep]
+            width = int(token_mask.sum(dim=1).max())
+            token_mask = token_mask[:, :width]
+            hidden_states = hidden_states[keep, :width]
+            extended_attention_mask = extended_attention_mask[keep][..., :width]
+            unpadded = UnpaddedBatch(token_mask) if bert.unpadded else None
+
+        logits[active] = self.classifier(bert.pooler(hidden_states)).to(logits.dtype)
+        return logits, layers_run
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None,
+                position_ids=None, cls_positions=None):
+        _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False,
+                                     position_ids=position_ids, cls_positions=cls_positions)
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
 
@@ -1220,3 +1538,68 @@ class BertForQuestionAnswering(BertPreTrainedModel):
             return total_loss
         else:
             return start_logits, end_logits
+
+
+class BertForSpanPairClassification(BertPreTrainedModel):
+    """BERT model for classifying all the entity pairs of a sentence from a single encoding of it.
+    Every span is represented by the mean of its final hidden states plus an embedding of its entity
+    type, and every pair by a hidden layer over its subject and object representations.
+
+    Params:
+        `config`: a BertConfig class instance with the configuration to build a new model.
+        `num_labels`: the number of classes for the classifier.
+        `num_entity_types`: the number of entity types of `pair_types`. Default = 1 (untyped).
+
+    Inputs:
+        `input_ids`: a torch.LongTensor of shape [batch_size, sequence_length] with the word token
+            indices of one sentence per row.
+        `token_type_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length], see `BertModel`.
+        `attention_mask`: an optional torch.LongTensor of shape [batch_size, sequence_length], see `BertModel`.
+        `pair_spans`: a torch.LongTensor of shape [num_pairs, 5] with, for every pair, its row in the
+            batch and the first and last token positions (inclusive) of its subject and of its object.
+        `pair_types`: an optional torch.LongTensor of shape [num_pairs, 2] with the entity types of the
+            subject and the object, in [0, ..., num_entity_types - 1].
+        `labels`: labels for the pairs: torch.LongTensor of shape [num_pairs] with indices selected
+            in [0, ..., num_labels].
+
+    Outputs:
+        if `labels` is not `None`:
+            Outputs the CrossEntropy classification loss of the output with the labels.
+        if `labels` is `None`:
+            Outputs the classification logits of shape [num_pairs, num_labels].
+    """
+    def __init__(self, config, num_labels, num_entity_types=1):
+        super(BertForSpanPairClassification, self).__init__(config)
+        self.num_labels = num_labels
+        self.bert = BertModel(config)
+        self.entity_type_embeddings = nn.Embedding(num_entity_types, config.hidden_size)
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.pair_dense = nn.Linear(2 * config.hidden_size, config.hidden_size)
+        self.classifier = nn.Linear(config.hidden_size, num_labels)
+        self.apply(self.init_bert_weights)
+
+    def span_representations(self, sequence_output, rows, starts, ends):
+        """ Mean of the hidden states of tokens `starts`..`ends` of rows `rows`, from prefix sums. """
+        prefix_sums = nn.functional.pad(sequence_output.cumsum(dim=1), (0, 0, 1, 0))
+        totals = prefix_sums[rows, ends + 1] - prefix_sums[rows, starts]
+        return totals / (ends - starts + 1).unsqueeze(-1).to(totals.dtype)
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, pair_spans=None, pair_types=None,
+                labels=None):
+        sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+        rows = pair_spans[:, 0]
+        subject = self.span_representations(sequence_output, rows, pair_spans[:, 1], pair_spans[:, 2])
+        object_ = self.span_representations(sequence_output, rows, pair_spans[:, 3], pair_spans[:, 4])
+        if pair_types is not None:
+            subject = subject + self.entity_type_embeddings(pair_types[:, 0])
+            object_ = object_ + self.entity_type_embeddings(pair_types[:, 1])
+        pair_output = self.dropout(torch.cat([subject, object_], dim=-1))
+        pair_output = self.dropout(gelu(self.pair_dense(pair_output)))
+        logits = self.classifier(pair_output)
+
+        if labels is not None:
+            loss_fct = CrossEntropyLoss()
+            loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
+            return loss
+        else:
+            return logits
@@ -0,0 +1,80 @@
+# coding=utf-8
+"""Int8 dynamic quantization of BERT classifiers for CPU inference."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import os
+
+import torch
+from torch import nn
+
+from .file_utils import CONFIG_NAME, WEIGHTS_NAME
+from .mmap_weights import SAFE_WEIGHTS_NAME
+from .modeling import BERT_CONFIG_NAME, BertSelfAttention, BertIntermediate, BertOutput
+
+logger = logging.getLogger(__name__)
+
+QUANTIZED_WEIGHTS_NAME = "pytorch_model_int8.bin"
+
+# Modules whose nn.Linear children are quantized; the classifier head is added by name.
+QUANTIZED_PARENTS = (BertSelfAttention, BertIntermediate, BertOutput)
+
+
+def _quantized_linear_names(model):
+    names = set()
+    for name, module in model.named_modules():
+        if isinstance(module, QUANTIZED_PARENTS):
+            for child_name, child in module.named_children():
+                if isinstance(child, nn.Linear):
+                    names.add(name + '.' + child_name if name else child_name)
+    if isinstance(getattr(model, 'classifier', None), nn.Linear):
+        names.add('classifier')
+    return names
+
+
+def quantize_dynamic_bert(model):
+    """ Returns a copy of `model` whose attention, feed-forward and classifier nn.Linear layers
+        run with int8 weights and dynamically quantized activations. CPU only.
+    """
+    names = _quantized_linear_names(model)
+    logger.info("Quantizing {} linear layers to int8".format(len(names)))
+    return torch.ao.quantization.quantize_dynamic(
+        model, {name: torch.ao.quantization.default_dynamic_qconfig for name in names}, dtype=torch.qint8)
+
+
+def source_fingerprint(pretrained_dir):
+    """ Name, size and modification time of the fp32 weights and config files in
+        `pretrained_dir`, recorded by `save_quantized` to tell when a quantized copy is stale.
+    """
+    fingerprint = []
+    for name in (WEIGHTS_NAME, SAFE_WEIGHTS_NAME, CONFIG_NAME, BERT_CONFIG_NAME):
+        path = os.path.join(pretrained_dir, name)
+        if os.path.exists(path):
+            stat = os.stat(path)
+            fingerprint.append([name, stat.st_size, stat.st_mtime_ns])
+    return fingerprint
+
+
+def save_quantized(model, weights_path, source=None):
+    """ Saves the state dict of a model returned by `quantize_dynamic_bert`, with the
+        `source_fingerprint` of the weights it was quantized from.
+    """
+    torch.save({'source': source, 'state_dict': model.state_dict()}, weights_path)
+
+
+def load_quantized(model, weights_path, source=None):
+    """ Loads weights saved by `save_quantized` into `model`, a freshly built fp32 model of the
+        same class and config, which is quantized first so its layout matches the checkpoint.
+        Returns None when `source` is given and the checkpoint was quantized from other weights
+        (or saved without a fingerprint), so the caller can quantize them again.
+    """
+    checkpoint = torch.load(weights_path, map_location='cpu')
+    if 'state_dict' not in checkpoint:
+        checkpoint = {'source': None, 'state_dict': checkpoint}
+    if source is not None and checkpoint['source'] != source:
+        logger.info("{} was quantized from other weights; ignoring it".format(weights_path))
+        return None
+    model = quantize_dynamic_bert(model)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model
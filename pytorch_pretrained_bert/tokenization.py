@@ -18,8 +18,11 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import collections
+import hashlib
+import json
 import logging
 import os
+import threading
 import unicodedata
 from io import open
 
@@ -62,6 +65,31 @@ def load_vocab(vocab_file):
     return vocab
 
 
+def build_wordpiece_trie(vocab):
+    """Builds character tries over the vocabulary for greedy longest-match wordpiece lookup.
+
+    Returns `(word_root, continuation_root)`: the first matches the start of a word against
+    every piece as written, the second matches the rest of a word against the `##`
+    continuation pieces with the prefix stripped. Each node is a dict from character to
+    child node; a node that ends a vocabulary piece stores that piece under the key `None`.
+    """
+    def insert(root, chars, piece):
+        if not chars:
+            return
+        node = root
+        for char in chars:
+            node = node.setdefault(char, {})
+        node[None] = piece
+
+    word_root = {}
+    continuation_root = {}
+    for piece in vocab:
+        insert(word_root, piece, piece)
+        if piece.startswith("##"):
+            insert(continuation_root, piece[2:], piece)
+    return word_root, continuation_root
+
+
 def whitespace_tokenize(text):
     """Runs basic whitespace cleaning and splitting on a piece of text."""
     text = text.strip()
@@ -71,11 +99,68 @@ def whitespace_tokenize(text):
     return tokens
 
 
+class WordpieceCache(object):
+    """Bounded LRU cache mapping a word to its wordpiece ids, with hit/miss counters."""
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, word):
+        """Returns the cached ids of `word` (marking it as recently used), or None."""
+        with self._lock:
+            ids = self._entries.get(word)
+            if ids is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(word)
+            self.hits += 1
+            return ids
+
+    def put(self, word, ids):
+        with self._lock:
+            self._entries[word] = ids
+            self._entries.move_to_end(word)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def save(self, path, fingerprint):
+        """Writes the entries, least recently used first, to a JSON snapshot."""
+        with self._lock:
+            entries = list(self._entries.items())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as writer:
+            json.dump({"fingerprint": fingerprint, "entries": entries}, writer)
+        os.replace(tmp_path, path)
+
+    def load(self, path, fingerprint):
+        """Loads a snapshot written by `save`; returns False if it was built for another vocabulary."""
+        with open(path, "r", encoding="utf-8") as reader:
+            snapshot = json.load(reader)
+        if snapshot.get("fingerprint") != fingerprint:
+            logger.warning("Ignoring wordpiece cache {}: it was built with a different vocabulary".format(path))
+            return False
+        for word, ids in snapshot["entries"]:
+            self.put(word, tuple(ids))
+        return True
+
+
 class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
     def __init__(self, vocab_file, do_lower_case=True, max_len=None, do_basic_tokenize=True,
-                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]")):
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]"), cache_size=100000):
         """Constructs a BertTokenizer.
 
         Args:
@@ -89,6 +174,8 @@ class BertTokenizer(object):
                          sequence length.
           never_split: List of tokens which will never be split during tokenization.
                          Only has an effect when do_wordpiece_only=False
+          cache_size: Maximum number of words kept in the word -> wordpiece ids cache
+                         used by `tokenize_to_ids`.
         """
         if not os.path.isfile(vocab_file):
             raise ValueError(
@@ -103,6 +190,10 @@ class BertTokenizer(object):
                                                   never_split=never_split)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
         self.max_len = max_len if max_len is not None else int(1e12)
+        self.wordpiece_cache = WordpieceCache(max_size=cache_size)
+        # Identifies the vocabulary and options a cache snapshot was built with.
+        self.cache_fingerprint = hashlib.sha256("\n".join(
+            [str(do_lower_case), str(do_basic_tokenize)] + list(self.vocab.keys())).encode("utf-8")).hexdigest()
 
     def tokenize(self, text):
         split_tokens = []
@@ -114,6 +205,22 @@ class BertTokenizer(object):
             split_tokens = self.wordpiece_tokenizer.tokenize(text)
         return split_tokens
 
+    def tokenize_to_ids(self, word):
+        """Tokenizes a single word straight to a tuple of wordpiece ids, memoized in `wordpiece_cache`."""
+        ids = self.wordpiece_cache.get(word)
+        if ids is None:
+            ids = tuple(self.vocab[token] for token in self.tokenize(word))
+            self.wordpiece_cache.put(word, ids)
+        return ids
+
+    def save_wordpiece_cache(self, path):
+        """Saves the word -> wordpiece ids cache so a later process can start warm."""
+        self.wordpiece_cache.save(path, self.cache_fingerprint)
+
+    def load_wordpiece_cache(self, path):
+        """Warms the word -> wordpiece ids cache from a snapshot written by `save_wordpiece_cache`."""
+        return self.wordpiece_cache.load(path, self.cache_fingerprint)
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
         ids = []
@@ -322,12 +429,14 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        self.word_trie, self.continuation_trie = build_wordpiece_trie(vocab)
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
 
         This uses a greedy longest-match-first algorithm to perform tokenization
-        using the given vocabulary.
+        using the given vocabulary. The longest match is found by walking a character
+        trie of the vocabulary once per piece instead of probing every substring.
 
         For example:
           input = "unaffable"
@@ -341,6 +450,46 @@ class WordpieceTokenizer(object):
           A list of wordpiece tokens.
         """
 
+        output_tokens = []
+        for token in whitespace_tokenize(text):
+            if len(token) > self.max_input_chars_per_word:
+                output_tokens.append(self.unk_token)
+                continue
+
+            is_bad = False
+            start = 0
+            sub_tokens = []
+            root = self.word_trie
+            while start < len(token):
+                node = root
+                cur_substr = None
+                end = start
+                pos = start
+                while pos < len(token):
+                    node = node.get(token[pos])
+                    if node is None:
+                        break
+                    pos += 1
+                    if None in node:
+                        cur_substr = node[None]
+                        end = pos
+                if cur_substr is None:
+                    is_bad = True
+                    break
+                sub_tokens.append(cur_substr)
+                start = end
+                root = self.continuation_trie
+
+            if is_bad:
+                output_tokens.append(self.unk_token)
+            else:
+                output_tokens.extend(sub_tokens)
+        return output_tokens
+
+    def _tokenize_by_substrings(self, text):
+        """Reference implementation of `tokenize` that probes the vocabulary with every
+        candidate substring, shrinking it one character at a time."""
+
         output_tokens = []
         for token in whitespace_tokenize(text):
             chars = list(token)
@@ -0,0 +1,33 @@
+"""
+Quantizes the SpanBERT classifier to int8 (saving it next to the fp32 weights) and reports
+how far its labels and confidences drift from fp32 on a held-out set of candidate pairs.
+
+Usage: python3 quantize_spanbert.py <pretrained dir> <examples.json>
+where examples.json holds a list of {"tokens": [...], "subj": [...], "obj": [...]} pairs.
+"""
+import json
+import sys
+
+from spanbert import SpanBERT, compare_predictions, timed_predict
+
+
+def main(pretrained_dir, examples_file):
+    with open(examples_file, "r", encoding="utf-8") as reader:
+        examples = json.load(reader)
+
+    fp32, fp32_time = timed_predict(SpanBERT(pretrained_dir), examples)
+    int8, int8_time = timed_predict(SpanBERT(pretrained_dir, quantize=True), examples)
+
+    report = compare_predictions(fp32, int8)
+    print(f"Examples:              {report['examples']}")
+    print(f"Label agreement:       {report['label_agreement']:.4f}")
+    print(f"Mean confidence drift: {report['mean_confidence_drift']:.5f}")
+    print(f"Max confidence drift:  {report['max_confidence_drift']:.5f}")
+    print(f"fp32: {fp32_time:.2f}s ; int8: {int8_time:.2f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python3 quantize_spanbert.py <pretrained dir> <examples.json>")
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2])
@@ -1,4 +1,3 @@
-import spacy
 from collections import defaultdict
 
 spacy2bert = { 
@@ -0,0 +1,123 @@
+"""
+Relation classifier that encodes every sentence once and classifies all of its candidate pairs
+from pooled span representations, instead of one marked-up encoder pass per pair like SpanBERT.
+Trained from SpanBERT's predictions with distill_span_pair.py; `predict` has the same interface.
+"""
+import random
+
+import numpy as np
+import torch
+
+from pytorch_pretrained_bert.modeling import BertForSpanPairClassification
+from spanbert import CLS, SEP, WARMUP_EXAMPLES, label_list, load_tokenizer, special_tokens
+
+# Entity types of the SUBJ=/OBJ= markers SpanBERT was fine-tuned with; 0 is any other type.
+ENTITY_TYPES = sorted({name.split("=", 1)[1] for name in special_tokens if "=" in name})
+entity_type_ids = {entity_type: i + 1 for i, entity_type in enumerate(ENTITY_TYPES)}
+NUM_ENTITY_TYPES = len(ENTITY_TYPES) + 1
+
+
+def convert_examples_to_sentences(examples, tokenizer, max_seq_length):
+    """Groups candidate pairs by sentence.
+
+    Returns `sentences`, the input ids of every distinct sentence ([CLS] wordpieces [SEP],
+    truncated to `max_seq_length`), and `pairs`, one row per example: its sentence index, the
+    first and last wordpiece of its subject and object, and their entity type ids.
+    """
+    vocab = tokenizer.vocab
+    last = max_seq_length - 2
+    sentence_index = {}
+    sentences = []
+    word_spans = []
+    pairs = np.zeros((len(examples), 7), dtype=np.int64)
+    for e, example in enumerate(examples):
+        key = tuple(example["tokens"])
+        if key not in sentence_index:
+            input_ids = [vocab[CLS]]
+            spans = []
+            for word in key:
+                start = len(input_ids)
+                input_ids.extend(tokenizer.tokenize_to_ids(word))
+                spans.append((min(start, last), min(max(len(input_ids) - 1, start), last)))
+            sentence_index[key] = len(sentences)
+            sentences.append(input_ids[:last + 1] + [vocab[SEP]])
+            word_spans.append(spans)
+        s = sentence_index[key]
+        spans = word_spans[s]
+        subj_span, obj_span = example["subj"][2], example["obj"][2]
+        pairs[e] = (s, spans[subj_span[0]][0], spans[subj_span[1]][1], spans[obj_span[0]][0], spans[obj_span[1]][1],
+                    entity_type_ids.get(example["subj"][1], 0), entity_type_ids.get(example["obj"][1], 0))
+    return sentences, pairs
+
+
+def build_sentence_batches(sentences, pairs, batch_size, shuffle=False, seed=42):
+    """Yields (input_ids, input_mask, pair_spans, pair_types, example_indices) for batches of
+    `batch_size` sentences with all of their pairs. Sentences are sorted by length unless
+    `shuffle` is set, and every batch is padded to its longest sentence."""
+    order = list(range(len(sentences)))
+    if shuffle:
+        random.Random(seed).shuffle(order)
+    else:
+        order.sort(key=lambda s: len(sentences[s]))
+    pairs_of = [[] for _ in sentences]
+    for e, s in enumerate(pairs[:, 0]):
+        pairs_of[s].append(e)
+
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        width = max(len(sentences[s]) for s in batch)
+        input_ids = np.zeros((len(batch), width), dtype=np.int64)
+        input_mask = np.zeros((len(batch), width), dtype=np.int64)
+        examples = []
+        rows = []
+        for row, s in enumerate(batch):
+            input_ids[row, :len(sentences[s])] = sentences[s]
+            input_mask[row, :len(sentences[s])] = 1
+            examples.extend(pairs_of[s])
+            rows.extend([row] * len(pairs_of[s]))
+        if not examples:
+            continue
+        examples = np.array(examples, dtype=np.int64)
+        pair_spans = pairs[examples, :5].copy()
+        pair_spans[:, 0] = rows
+        yield (torch.from_numpy(input_ids), torch.from_numpy(input_mask), torch.from_numpy(pair_spans),
+               torch.from_numpy(pairs[examples, 5:]), examples)
+
+
+class SpanPairBERT:
+    def __init__(self, pretrained_dir, model=None):
+        self.max_seq_length = 256
+        self.batch_size = 16
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.id2label = {i: label for i, label in enumerate(label_list)}
+        self.num_labels = len(label_list)
+        # distill_span_pair.py saves the vocabulary next to the weights.
+        self.tokenizer = load_tokenizer(pretrained_dir, model)
+        print("Loading span-pair relation model from {}".format(pretrained_dir))
+        self.classifier = BertForSpanPairClassification.from_pretrained(
+            pretrained_dir, num_labels=self.num_labels, num_entity_types=NUM_ENTITY_TYPES)
+        self.classifier.to(self.device)
+        self.classifier.eval()
+
+    def predict_logits(self, examples):
+        """Returns the logits of every example as a [len(examples), num_labels] float32 array."""
+        logits = np.empty((len(examples), self.num_labels), dtype=np.float32)
+        sentences, pairs = convert_examples_to_sentences(examples, self.tokenizer, self.max_seq_length)
+        for input_ids, input_mask, pair_spans, pair_types, indices in build_sentence_batches(
+                sentences, pairs, self.batch_size):
+            with torch.no_grad():
+                batch_logits = self.classifier(input_ids.to(self.device), None, input_mask.to(self.device),
+                                               pair_spans=pair_spans.to(self.device),
+                                               pair_types=pair_types.to(self.device))
+            logits[indices] = batch_logits.float().cpu().numpy()
+        return logits
+
+    def predict(self, examples):
+        logits = torch.from_numpy(self.predict_logits(examples))
+        max_log_proba, pred_ids = torch.log_softmax(logits, dim=-1).max(dim=-1)
+        return [(self.id2label[int(pred)], confidence)
+                for pred, confidence in zip(pred_ids.numpy(), max_log_proba.exp().numpy())]
+
+    def warmup(self):
+        """Runs one small prediction so the first real batch does not pay for lazy initialization."""
+        self.predict(WARMUP_EXAMPLES)
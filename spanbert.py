@@ -4,18 +4,28 @@ Run SpanBERT on general test examples
 Scripts adopted from https://github.com/facebookresearch/SpanBERT and edited by Giannis Karamanolakis
 """
 
+import atexit
+import itertools
 import os
 import random
+import sys
+import threading
 import time
 import json
 
 import numpy as np
 import torch
-from torch.utils.data import DataLoader, TensorDataset
 #from transformers import AutoTokenizer, AutoModel, BertForSequenceClassification
-from pytorch_pretrained_bert.modeling import BertForSequenceClassification
-from pytorch_pretrained_bert.tokenization import BertTokenizer
-from scipy.special import softmax
+from pytorch_pretrained_bert.file_utils import CONFIG_NAME, WEIGHTS_NAME
+from pytorch_pretrained_bert.modeling import BERT_CONFIG_NAME, BertConfig, BertForSequenceClassification
+from pytorch_pretrained_bert.mmap_weights import SAFE_WEIGHTS_NAME, convert_checkpoint
+from pytorch_pretrained_bert.optimization import BertAdam
+from pytorch_pretrained_bert.quantization import (QUANTIZED_WEIGHTS_NAME, quantize_dynamic_bert,
+                                                  save_quantized, load_quantized, source_fingerprint)
+from pytorch_pretrained_bert.tokenization import VOCAB_NAME, BertTokenizer
+
+# Early-exit classifiers of every encoder layer, saved by train_exit_heads.py.
+EXIT_HEADS_NAME = "exit_heads.bin"
 
 CLS = "[CLS]"
 SEP = "[SEP]"
@@ -42,22 +52,8 @@ class InputFeatures(object):
         self.segment_ids = segment_ids
 
 
-def convert_examples_to_features(examples, max_seq_length, tokenizer, special_tokens):
-    """Loads a data file into a list of `InputBatch`s."""
-
-    def create_examples(dataset):
-        """Creates examples for the training and dev sets."""
-        examples = []
-        for example in dataset:
-            sentence = example['tokens']
-            examples.append(InputExample(
-                sentence=example['tokens'],
-                ner1=example['subj'][1],
-                span1=example['subj'][2],
-                ner2=example['obj'][1],
-                span2=example['obj'][2]
-                ))
-        return examples
+def convert_examples_to_ids(examples, max_seq_length, tokenizer, special_tokens):
+    """Turns candidate pair dicts straight into lists of input ids, truncated to `max_seq_length`."""
 
     def get_special_token(w):
         if w not in special_tokens:
@@ -65,109 +61,372 @@ def convert_examples_to_features(examples, max_seq_length, tokenizer, special_to
             #special_tokens[w] = "[unused%d]" % (len(special_tokens) + 1)
         return special_tokens[w]
 
-    examples = create_examples(examples)
-    num_tokens = 0
-    num_fit_examples = 0
-    num_shown_examples = 0
-    features = []
-    for (ex_index, example) in enumerate(examples):
-        tokens = [CLS]
-        SUBJECT_START = get_special_token("SUBJ_START")
-        SUBJECT_END = get_special_token("SUBJ_END")
-        OBJECT_START = get_special_token("OBJ_START")
-        OBJECT_END = get_special_token("OBJ_END")
-        SUBJECT_NER = get_special_token("SUBJ=%s" % example.ner1)
-        OBJECT_NER = get_special_token("OBJ=%s" % example.ner2)
-
-        subj_tokens = []
-        obj_tokens = []
-        for i, token in enumerate(example.sentence):
-            if i == example.span1[0]:
+    vocab = tokenizer.vocab
+    CLS_ID = vocab[CLS]
+    SEP_ID = vocab[SEP]
+    all_input_ids = []
+    for example in examples:
+        sentence = example['tokens']
+        ner1, span1 = example['subj'][1], example['subj'][2]
+        ner2, span2 = example['obj'][1], example['obj'][2]
+
+        # Words are mapped straight to wordpiece ids through the tokenizer's word cache.
+        tokens = [CLS_ID]
+        SUBJECT_NER = vocab[get_special_token("SUBJ=%s" % ner1)]
+        OBJECT_NER = vocab[get_special_token("OBJ=%s" % ner2)]
+
+        for i, token in enumerate(sentence):
+            if i == span1[0]:
                 tokens.append(SUBJECT_NER)
-            if i == example.span2[0]:
+            if i == span2[0]:
                 tokens.append(OBJECT_NER)
-            if (i >= example.span1[0]) and (i <= example.span1[1]):
-                for sub_token in tokenizer.tokenize(token):
-                    subj_tokens.append(sub_token)
-            elif (i >= example.span2[0]) and (i <= example.span2[1]):
-                for sub_token in tokenizer.tokenize(token):
-                    obj_tokens.append(sub_token)
-            else:
-                for sub_token in tokenizer.tokenize(token):
+            # Words inside the subject and object spans are represented by their NER markers.
+            if not (span1[0] <= i <= span1[1]) and not (span2[0] <= i <= span2[1]):
+                for sub_token in tokenizer.tokenize_to_ids(token):
                     tokens.append(sub_token)
                     tokens.append(sub_token)
-            tokens.append(SEP)
-        num_tokens += len(tokens)
+            tokens.append(SEP_ID)
 
         if len(tokens) > max_seq_length:
             tokens = tokens[:max_seq_length]
-        else:
-            num_fit_examples += 1
+        all_input_ids.append(tokens)
+    return all_input_ids
+
+
+def convert_examples_to_features(examples, max_seq_length, tokenizer, special_tokens, pad_to_max_length=True):
+    """Loads a data file into a list of `InputBatch`s.
 
-        segment_ids = [0] * len(tokens)
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)
+    With `pad_to_max_length=False` the features keep their real length (truncated to
+    `max_seq_length`).
+    """
+    features = []
+    for input_ids in convert_examples_to_ids(examples, max_seq_length, tokenizer, special_tokens):
+        segment_ids = [0] * len(input_ids)
         input_mask = [1] * len(input_ids)
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
+        if pad_to_max_length:
+            padding = [0] * (max_seq_length - len(input_ids))
+            input_ids += padding
+            input_mask += padding
+            segment_ids += padding
 
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
+            assert len(input_ids) == max_seq_length
+            assert len(input_mask) == max_seq_length
+            assert len(segment_ids) == max_seq_length
 
         features.append(
                 InputFeatures(input_ids=input_ids,
                               input_mask=input_mask,
                               segment_ids=segment_ids
                               ))
-    #  print("Average #tokens: %.2f" % (num_tokens * 1.0 / len(examples)))
-    #  print("%d (%.2f %%) examples can fit max_seq_length = %d" % (num_fit_examples,
-    #      num_fit_examples * 100.0 / len(examples), max_seq_length))
     return features
 
 
-def predict(model, device, eval_dataloader, verbose=True):
+class FeatureBuffers(object):
+    """Preallocated int64 buffers for the input ids, masks and segment ids of a prediction call.
+
+    Batches are laid out back to back, each padded only to its own width, so every batch is
+    a contiguous block that `torch.from_numpy` wraps without copying. The buffers only grow
+    and are reused across calls.
+    """
+
+    def __init__(self, capacity=32 * 128):
+        self.input_ids = np.zeros(capacity, dtype=np.int64)
+        self.input_mask = np.zeros(capacity, dtype=np.int64)
+        self.segment_ids = np.zeros(capacity, dtype=np.int64)
+
+    def _reserve(self, size):
+        if size > len(self.input_ids):
+            capacity = max(size, 2 * len(self.input_ids))
+            self.input_ids = np.zeros(capacity, dtype=np.int64)
+            self.input_mask = np.zeros(capacity, dtype=np.int64)
+            self.segment_ids = np.zeros(capacity, dtype=np.int64)
+
+    def build_batches(self, all_input_ids, batch_size, max_seq_length=None):
+        """Writes `all_input_ids` into the buffers in batches of `batch_size` rows.
+
+        Rows are sorted by length and every batch is padded to its longest row; when
+        `max_seq_length` is given, rows keep their order and every batch is padded to it.
+        Returns the (input_ids, input_mask, segment_ids) tensors of every batch and `order`,
+        the example index of every row, so results can be put back in the original order.
+        """
+        num_rows = len(all_input_ids)
+        lengths = np.fromiter((len(ids) for ids in all_input_ids), dtype=np.int64, count=num_rows)
+        if max_seq_length is None:
+            order = np.argsort(lengths, kind="stable")
+        else:
+            order = np.arange(num_rows)
+        lengths = lengths[order]
+
+        batch_starts = np.arange(0, num_rows, batch_size)
+        batch_ends = np.minimum(batch_starts + batch_size, num_rows)
+        if max_seq_length is None:
+            # Lengths are sorted, so the last row of a batch is its longest.
+            widths = lengths[batch_ends - 1]
+        else:
+            widths = np.full(len(batch_starts), max_seq_length, dtype=np.int64)
+        batch_offsets = np.concatenate(([0], np.cumsum((batch_ends - batch_starts) * widths)))
+        total = int(batch_offsets[-1])
+        self._reserve(total)
+
+        # Flat position of every real token: start of its row plus its index in the row.
+        rows = np.arange(num_rows)
+        row_batch = rows // batch_size
+        row_offsets = batch_offsets[row_batch] + (rows - batch_starts[row_batch]) * widths[row_batch]
+        num_tokens = int(lengths.sum())
+        token_ids = np.fromiter(itertools.chain.from_iterable(all_input_ids[i] for i in order),
+                                dtype=np.int64, count=num_tokens)
+        row_starts = np.repeat(np.cumsum(lengths) - lengths, lengths)
+        positions = np.repeat(row_offsets, lengths) + (np.arange(num_tokens) - row_starts)
+
+        input_ids = self.input_ids[:total]
+        input_mask = self.input_mask[:total]
+        input_ids.fill(0)
+        input_mask.fill(0)
+        self.segment_ids[:total].fill(0)
+        input_ids[positions] = token_ids
+        input_mask[positions] = 1
+
+        batches = []
+        for b in range(len(batch_starts)):
+            lo, hi = int(batch_offsets[b]), int(batch_offsets[b + 1])
+            shape = (int(batch_ends[b] - batch_starts[b]), int(widths[b]))
+            batches.append(tuple(torch.from_numpy(buffer[lo:hi].reshape(shape))
+                                 for buffer in (self.input_ids, self.input_mask, self.segment_ids)))
+        return batches, order
+
+
+def pack_batches(all_input_ids, batch_size, max_seq_length):
+    """Packs several examples into every row of at most `max_seq_length` tokens.
+
+    Examples are placed first-fit in decreasing length order, and batches of `batch_size` rows
+    are padded to their longest row. Every example attends only to itself (block-diagonal
+    mask), its positions restart at 0, and it is read out at its own [CLS] token.
+    Returns the (input_ids, attention_mask, segment_ids, position_ids, cls_positions) tensors
+    of every batch and `order`, the example index of every read-out.
+    """
+    lengths = [len(input_ids) for input_ids in all_input_ids]
+    rows = []
+    room = []
+    for i in sorted(range(len(all_input_ids)), key=lambda i: -lengths[i]):
+        for r in range(len(rows)):
+            if lengths[i] <= room[r]:
+                rows[r].append(i)
+                room[r] -= lengths[i]
+                break
+        else:
+            rows.append([i])
+            room.append(max_seq_length - lengths[i])
+
+    batches = []
+    order = []
+    for start in range(0, len(rows), batch_size):
+        batch_rows = rows[start:start + batch_size]
+        width = max_seq_length - min(room[start:start + batch_size])
+        input_ids = np.zeros((len(batch_rows), width), dtype=np.int64)
+        position_ids = np.zeros((len(batch_rows), width), dtype=np.int64)
+        blocks = np.full((len(batch_rows), width), -1, dtype=np.int64)
+        cls_positions = []
+        for r, examples in enumerate(batch_rows):
+            offset = 0
+            for block, i in enumerate(examples):
+                end = offset + lengths[i]
+                input_ids[r, offset:end] = all_input_ids[i]
+                position_ids[r, offset:end] = np.arange(lengths[i])
+                blocks[r, offset:end] = block
+                cls_positions.append((r, offset))
+                order.append(i)
+                offset = end
+        attention_mask = (blocks[:, :, None] == blocks[:, None, :]) & (blocks[:, :, None] >= 0)
+        batches.append((torch.from_numpy(input_ids), torch.from_numpy(attention_mask.astype(np.int64)),
+                        torch.zeros(input_ids.shape, dtype=torch.long), torch.from_numpy(position_ids),
+                        torch.tensor(cls_positions, dtype=torch.long)))
+    return batches, np.array(order, dtype=np.int64)
+
+
+def iter_logits(model, device, eval_dataloader, exit_threshold=None, exit_layers=None):
+    """Yields the logits of every batch, left on `device`.
+
+    Packed batches (from `pack_batches`) yield one row of logits per packed example.
+    With `exit_threshold`, the model's exit heads stop confident rows early (see
+    `BertForSequenceClassification.forward_early_exit`), and the number of layers every row
+    ran through is appended to the `exit_layers` list, if given.
+    """
     model.eval()
-    preds = []
-    for input_ids, input_mask, segment_ids in eval_dataloader:
-        input_ids = input_ids.to(device)
-        input_mask = input_mask.to(device)
-        segment_ids = segment_ids.to(device)
+    for batch in eval_dataloader:
+        input_ids, input_mask, segment_ids = (t.to(device) for t in batch[:3])
+        packing = {}
+        if len(batch) > 3:
+            packing = {"position_ids": batch[3].to(device), "cls_positions": batch[4].to(device)}
         with torch.no_grad():
-            logits = model(input_ids, segment_ids, input_mask, labels=None)
-        if len(preds) == 0:
-            preds.append(logits.detach().cpu().numpy())
-        else:
-            preds[0] = np.append(
-                preds[0], logits.detach().cpu().numpy(), axis=0)
+            if exit_threshold is not None:
+                logits, layers_run = model.forward_early_exit(input_ids, segment_ids, input_mask,
+                                                              exit_threshold=exit_threshold)
+                if exit_layers is not None:
+                    exit_layers.append(layers_run.cpu().numpy())
+            else:
+                logits = model(input_ids, segment_ids, input_mask, labels=None, **packing)
+        yield logits
+
+
+def iter_predict(model, device, eval_dataloader, exit_threshold=None, exit_layers=None):
+    """Yields the predicted label ids and their probabilities for every batch.
+
+    The argmax and the max-probability come from a log-softmax computed in torch, so only
+    two vectors per batch leave the model instead of the full logits.
+    """
+    for logits in iter_logits(model, device, eval_dataloader, exit_threshold, exit_layers):
+        max_log_proba, pred_ids = torch.log_softmax(logits.float(), dim=-1).max(dim=-1)
+        yield pred_ids.cpu().numpy(), max_log_proba.exp().cpu().numpy()
 
-    pred_ids = np.argmax(preds[0], axis=1)
-    pred_proba = np.max(softmax(preds[0], axis=1), axis=1)
+
+def distillation_loss(student_logits, teacher_logits, temperature=2.0):
+    """KL divergence between the temperature-softened teacher and student distributions,
+    scaled by temperature^2 so gradients keep their magnitude across temperatures."""
+    student_log_proba = torch.log_softmax(student_logits / temperature, dim=-1)
+    teacher_proba = torch.softmax(teacher_logits / temperature, dim=-1)
+    return torch.nn.functional.kl_div(student_log_proba, teacher_proba, reduction="batchmean") * temperature ** 2
+
+
+def bert_optimizer(model, learning_rate, num_train_steps):
+    """BertAdam over all of `model`'s parameters, without weight decay on biases and LayerNorm."""
+    no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
+    param_optimizer = list(model.named_parameters())
+    optimizer_grouped_parameters = [
+        {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)], 'weight_decay': 0.01},
+        {'params': [p for n, p in param_optimizer if any(nd in n for nd in no_decay)], 'weight_decay': 0.0}
+    ]
+    return BertAdam(optimizer_grouped_parameters, lr=learning_rate, warmup=0.1, t_total=num_train_steps)
+
+
+def load_tokenizer(pretrained_dir, model=None):
+    """The cased SpanBERT tokenizer: `model`'s vocabulary if given, else the one saved next to the
+    weights in `pretrained_dir` (by the distillation scripts), else spanbert-base-cased's."""
+    if model is None:
+        has_vocab = os.path.exists(os.path.join(pretrained_dir, VOCAB_NAME))
+        model = pretrained_dir if has_vocab else "spanbert-base-cased"
+    return BertTokenizer.from_pretrained(model, do_lower_case=False)
+
+
+# Run once by `warmup`, so the first real batch does not pay for lazy initialization.
+WARMUP_EXAMPLES = [{"tokens": "Bill Gates is the founder of Microsoft".split(),
+                    "subj": ('Bill Gates', "PERSON", (0, 1)), "obj": ('Microsoft', "ORGANIZATION", (6, 6))}]
+
+
+def predict(model, device, eval_dataloader, order=None, verbose=True, exit_threshold=None, exit_layers=None):
+    """Runs the model over every batch, writing predictions into preallocated arrays.
+
+    `order` gives the example index of every row (as returned by `FeatureBuffers.build_batches`);
+    the results are then stored in example order. `exit_threshold` and `exit_layers` are
+    passed on to `iter_logits`.
+    """
+    num_examples = len(order) if order is not None else sum(len(batch[0]) for batch in eval_dataloader)
+    pred_ids = np.empty(num_examples, dtype=np.int64)
+    pred_proba = np.empty(num_examples, dtype=np.float32)
+    offset = 0
+    for batch_ids, batch_proba in iter_predict(model, device, eval_dataloader, exit_threshold, exit_layers):
+        rows = slice(offset, offset + len(batch_ids))
+        index = rows if order is None else order[rows]
+        pred_ids[index] = batch_ids
+        pred_proba[index] = batch_proba
+        offset += len(batch_ids)
     return pred_ids, pred_proba
 
 
 class SpanBERT:
-    def __init__(self, pretrained_dir, model="spanbert-base-cased"):
+    def __init__(self, pretrained_dir, model=None, wordpiece_cache_file=None, quantize=False,
+                 backend="pytorch", fast_attention=True, unpadded=True, packing=False,
+                 early_exit_threshold=None):
         assert os.path.exists(pretrained_dir), "Pre-trained model folder does not exist: {}".format(pretrained_dir)
         self.seed = 42
         self.max_seq_length = 128
         self.batch_size = 32
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.n_gpu = torch.cuda.device_count()
+        self.dynamic_padding = True
+        self._buffers = FeatureBuffers(self.batch_size * self.max_seq_length)
+        self._buffers_lock = threading.Lock()
+        if backend not in ("pytorch", "onnx"):
+            raise ValueError("backend must be 'pytorch' or 'onnx', got '{}'".format(backend))
+        self.backend = backend
+        # Pack several short examples into every max_seq_length row, see `pack_batches`.
+        if packing and backend == "onnx":
+            raise ValueError("packing is only supported by the pytorch backend")
+        self.packing = packing
+        # Stop at the first layer whose exit head is at least this confident, see
+        # train_exit_heads.py; None runs every layer.
+        if early_exit_threshold is not None and (packing or backend == "onnx"):
+            raise ValueError("early exit is only supported by the pytorch backend, without packing")
+        self.early_exit_threshold = early_exit_threshold
+        # Average number of encoder layers per example in the last `predict` with early exit.
+        self.average_layers = None
+        # Int8 dynamic quantization and onnxruntime only run on the CPU.
+        self.quantize = quantize
+        cpu_only = quantize or backend == "onnx"
+        self.device = torch.device("cuda" if torch.cuda.is_available() and not cpu_only else "cpu")
+        self.n_gpu = torch.cuda.device_count() if not cpu_only else 0
         self.fp16 = self.n_gpu > 0
         self._set_seed()
         self.label2id = {label: i for i, label in enumerate(label_list)}
         self.id2label = {i: label for i, label in enumerate(label_list)}
         self.num_labels = len(label_list)    
         #self.tokenizer = AutoTokenizer.from_pretrained("SpanBERT/spanbert-base-cased", do_lower_case=False)
-        self.tokenizer = BertTokenizer.from_pretrained(model, do_lower_case=False)
+        # Students trained by distill_student.py keep their vocabulary next to their weights;
+        # the architecture always comes from the config in `pretrained_dir`.
+        self.tokenizer = load_tokenizer(pretrained_dir, model)
+        # Optional snapshot of the tokenizer's word -> wordpiece ids cache, reloaded at startup
+        # and written back at exit.
+        self.wordpiece_cache_file = wordpiece_cache_file
+        if wordpiece_cache_file is not None:
+            if os.path.exists(wordpiece_cache_file):
+                self.tokenizer.load_wordpiece_cache(wordpiece_cache_file)
+            atexit.register(self.tokenizer.save_wordpiece_cache, wordpiece_cache_file)
 
         print("Loading pre-trained spanBERT from {}".format(pretrained_dir))
-        self.classifier = BertForSequenceClassification.from_pretrained(pretrained_dir, num_labels=self.num_labels)
-        if self.fp16:
-            self.classifier.half()
-        self.classifier.to(self.device)
+        if backend == "onnx":
+            onnx_path = os.path.join(pretrained_dir, ONNX_MODEL_NAME)
+            assert os.path.exists(onnx_path), \
+                "ONNX model does not exist: {}; export it with `python3 spanbert.py --export-onnx`".format(onnx_path)
+            self.classifier = OnnxClassifier(onnx_path)
+        else:
+            if quantize:
+                self.classifier = self._load_quantized(pretrained_dir)
+            else:
+                # On the GPU, fp16 weights converted by --convert-weights are used without a copy.
+                self.classifier = BertForSequenceClassification.from_pretrained(
+                    pretrained_dir, num_labels=self.num_labels, torch_dtype=torch.float16 if self.fp16 else None)
+            if self.fp16:
+                self.classifier.half()
+            self.classifier.to(self.device)
+            # Packed QKV projection and fused attention kernels; set False for the exact
+            # original attention arithmetic.
+            self.classifier.enable_fast_attention(fast_attention)
+            # Run the dense layers of the encoder on the real tokens of each batch only.
+            self.classifier.bert.enable_unpadded(unpadded)
+            exit_heads_path = os.path.join(pretrained_dir, EXIT_HEADS_NAME)
+            if os.path.exists(exit_heads_path):
+                exit_heads = self.classifier.add_exit_heads()
+                exit_heads.load_state_dict(torch.load(exit_heads_path, map_location="cpu"))
+                exit_heads.to(self.device, torch.float16 if self.fp16 else torch.float32)
+            elif early_exit_threshold is not None:
+                raise ValueError("No exit heads in {}; train them with train_exit_heads.py".format(pretrained_dir))
+
+    def _load_quantized(self, pretrained_dir):
+        """Loads the int8 classifier saved next to the fp32 weights, quantizing and saving it on
+        first use and whenever the fp32 weights or config have changed since."""
+        weights_path = os.path.join(pretrained_dir, QUANTIZED_WEIGHTS_NAME)
+        source = source_fingerprint(pretrained_dir)
+        if os.path.exists(weights_path):
+            config_file = os.path.join(pretrained_dir, CONFIG_NAME)
+            if not os.path.exists(config_file):
+                config_file = os.path.join(pretrained_dir, BERT_CONFIG_NAME)
+            config = BertConfig.from_json_file(config_file)
+            classifier = BertForSequenceClassification.build_uninitialized(config, num_labels=self.num_labels)
+            classifier = load_quantized(classifier, weights_path, source=source)
+            if classifier is not None:
+                return classifier
+        print("Quantizing spanBERT to int8 ...")
+        classifier = BertForSequenceClassification.from_pretrained(pretrained_dir, num_labels=self.num_labels)
+        classifier = quantize_dynamic_bert(classifier.eval())
+        save_quantized(classifier, weights_path, source=source)
+        return classifier
 
     def _set_seed(self):
         random.seed(self.seed)
@@ -176,20 +435,160 @@ class SpanBERT:
         if self.n_gpu > 0:
             torch.cuda.manual_seed_all(self.seed)
 
-    def predict(self, examples):
-        features = convert_examples_to_features(examples, self.max_seq_length, self.tokenizer, special_tokens)
-        all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
-        data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids)
-        dataloader = DataLoader(data, batch_size=self.batch_size)
-        preds, proba = predict(self.classifier, self.device, dataloader)
+    def _build_batches(self, examples):
+        all_input_ids = convert_examples_to_ids(examples, self.max_seq_length, self.tokenizer, special_tokens)
+        if self.packing:
+            return pack_batches(all_input_ids, self.batch_size, self.max_seq_length)
+        if self.dynamic_padding:
+            # Sort by length and pad every batch only to its longest example; attention
+            # cost grows with the square of the padded length.
+            return self._buffers.build_batches(all_input_ids, self.batch_size)
+        return self._buffers.build_batches(all_input_ids, self.batch_size, max_seq_length=self.max_seq_length)
+
+    def predict(self, examples, exit_threshold=None):
+        """Returns a (label, confidence) pair for every example. `exit_threshold` overrides
+        the `early_exit_threshold` the model was loaded with."""
+        if exit_threshold is None:
+            exit_threshold = self.early_exit_threshold
+        if exit_threshold is not None and getattr(self.classifier, "exit_heads", None) is None:
+            raise ValueError("early exit needs the exit heads trained by train_exit_heads.py")
+        exit_layers = []
+        with self._buffers_lock:
+            batches, order = self._build_batches(examples)
+            preds, proba = predict(self.classifier, self.device, batches, order=order,
+                                   exit_threshold=exit_threshold, exit_layers=exit_layers)
+        self.average_layers = float(np.concatenate(exit_layers).mean()) if exit_layers else None
         preds = [self.id2label[pred] for pred in preds]
         return list(zip(preds, proba))
 
+    def predict_logits(self, examples):
+        """Returns the logits of every example as a [len(examples), num_labels] float32 array,
+        e.g. as soft targets for distillation."""
+        logits = np.empty((len(examples), self.num_labels), dtype=np.float32)
+        with self._buffers_lock:
+            batches, order = self._build_batches(examples)
+            offset = 0
+            for batch_logits in iter_logits(self.classifier, self.device, batches):
+                logits[order[offset:offset + len(batch_logits)]] = batch_logits.float().cpu().numpy()
+                offset += len(batch_logits)
+        return logits
+
+    def warmup(self):
+        """Runs one small prediction so the first real batch does not pay for lazy initialization."""
+        self.predict(WARMUP_EXAMPLES)
+
+    def predict_iter(self, examples):
+        """Like `predict`, but yields the results of every batch as soon as it is classified.
+
+        Each item is a list of (example index, (label, confidence)); batches are not in input
+        order. The batches are copied out of the shared input buffers before the first one is
+        classified, so other predictions are not held up while the caller consumes the results.
+        """
+        with self._buffers_lock:
+            batches, order = self._build_batches(examples)
+            batches = [tuple(t.clone() for t in batch) for batch in batches]
+        offset = 0
+        for batch_ids, batch_proba in iter_predict(self.classifier, self.device, batches):
+            indices = order[offset:offset + len(batch_ids)]
+            offset += len(batch_ids)
+            yield [(int(i), (self.id2label[pred], confidence))
+                   for i, pred, confidence in zip(indices, batch_ids, batch_proba)]
+
+ONNX_MODEL_NAME = "spanbert.onnx"
+
+
+def export_onnx(classifier, onnx_path, opset_version=18):
+    """Exports a BertForSequenceClassification to ONNX with dynamic batch and sequence axes."""
+    classifier.eval()
+    # Separate tensors per input: the exporter merges inputs that are the same tensor object.
+    input_ids = torch.full((2, 8), 100, dtype=torch.long)
+    token_type_ids = torch.zeros(2, 8, dtype=torch.long)
+    attention_mask = torch.ones(2, 8, dtype=torch.long)
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in ("input_ids", "token_type_ids", "attention_mask")}
+    dynamic_axes["logits"] = {0: "batch"}
+    torch.onnx.export(classifier, (input_ids, token_type_ids, attention_mask), onnx_path,
+                      input_names=["input_ids", "token_type_ids", "attention_mask"],
+                      output_names=["logits"],
+                      dynamic_axes=dynamic_axes,
+                      opset_version=opset_version)
+
+
+class OnnxClassifier(object):
+    """Runs an exported classifier with onnxruntime; called like the PyTorch model and returns logits."""
+
+    def __init__(self, onnx_path, num_threads=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            print("The ONNX backend requires onnxruntime to be installed: pip install onnxruntime")
+            raise
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def eval(self):
+        return self
+
+    def __call__(self, input_ids, token_type_ids, attention_mask, labels=None):
+        logits, = self.session.run(["logits"], {
+            "input_ids": input_ids.cpu().numpy(),
+            "token_type_ids": token_type_ids.cpu().numpy(),
+            "attention_mask": attention_mask.cpu().numpy(),
+        })
+        return torch.from_numpy(logits)
+
+
+def timed_predict(bert, examples):
+    """The predictions of `bert` for `examples` and the seconds they took."""
+    start = time.perf_counter()
+    preds = bert.predict(examples)
+    return preds, time.perf_counter() - start
+
+
+def compare_predictions(reference, candidate):
+    """Measures how far `candidate` predictions drift from `reference` ones.
+
+    Both are lists of (label, confidence) pairs for the same examples, as returned by
+    `SpanBERT.predict`.
+    """
+    if len(reference) != len(candidate):
+        raise ValueError("Expected predictions for the same examples, got {} and {}".format(len(reference), len(candidate)))
+    if not reference:
+        return {"examples": 0, "label_agreement": 1.0, "mean_confidence_drift": 0.0, "max_confidence_drift": 0.0}
+    same_label = [ref[0] == cand[0] for ref, cand in zip(reference, candidate)]
+    drift = np.abs(np.array([ref[1] for ref in reference]) - np.array([cand[1] for cand in candidate]))
+    return {
+        "examples": len(reference),
+        "label_agreement": float(np.mean(same_label)),
+        "mean_confidence_drift": float(drift.mean()),
+        "max_confidence_drift": float(drift.max()),
+    }
+
+
 if __name__ == "__main__":
     pretrained_dir = os.path.abspath("./pretrained_spanbert")
-    bert = SpanBERT(pretrained_dir=pretrained_dir)
+    if "--export-onnx" in sys.argv:
+        bert = SpanBERT(pretrained_dir=pretrained_dir, unpadded=False)
+        if bert.fp16:
+            bert.classifier.float()
+        onnx_path = os.path.join(pretrained_dir, ONNX_MODEL_NAME)
+        export_onnx(bert.classifier.cpu(), onnx_path)
+        print("Exported ONNX model to {}".format(onnx_path))
+        sys.exit(0)
+    if "--convert-weights" in sys.argv:
+        # One-time conversion to a memory-mapped weight file, picked up by from_pretrained.
+        dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(sys.argv[-1])
+        output_path = os.path.join(pretrained_dir, SAFE_WEIGHTS_NAME)
+        convert_checkpoint(os.path.join(pretrained_dir, WEIGHTS_NAME), output_path, dtype=dtype)
+        print("Converted weights to {}".format(output_path))
+        if dtype is not None:
+            print("Note: SpanBERT runs in fp32 on the CPU, where these weights are copied to fp32 when loaded; "
+                  "they are only used in place by fp16 GPU runs.")
+        sys.exit(0)
+    backend = "onnx" if "--onnx" in sys.argv else "pytorch"
+    bert = SpanBERT(pretrained_dir=pretrained_dir, backend=backend)
     examples = [
             {"tokens": "Bill Gates is the founder of Microsoft".split(), "subj": ('Bill Gates', "PERSON", (0,1)), "obj": ('Microsoft', "ORGANIZATION", (6,6))},
             {"tokens": "Bill Gates is the founder of Microsoft".split(), "obj": ('Bill Gates', "PERSON", (0,1)), "subj": ('Microsoft', "ORGANIZATION", (6,6))}
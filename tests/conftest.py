@@ -0,0 +1,70 @@
+import json
+import os
+import random
+import sys
+
+import pytest
+
+# The modules under test live at the top of the repository, next to driver.py.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ("Bill Gates is the founder of Microsoft and lives in Seattle Washington with his family ; "
+         "the company was founded in 1975 by Paul Allen .").split()
+
+
+def write_tiny_model(model_dir, num_layers=2, hidden_size=32, num_attention_heads=4, intermediate_size=48):
+    """A randomly initialized SpanBERT-shaped classifier with a small vocabulary, saved the way
+    `SpanBERT(model_dir)` loads it. Its head size (8) and intermediate size (not 4x hidden) differ
+    from bert-base on purpose."""
+    import torch
+    from pytorch_pretrained_bert.file_utils import CONFIG_NAME, WEIGHTS_NAME
+    from pytorch_pretrained_bert.modeling import BertConfig, BertForSequenceClassification
+    from pytorch_pretrained_bert.tokenization import VOCAB_NAME
+    from spanbert import label_list
+
+    vocab = ["[PAD]"] + ["[unused%d]" % i for i in range(1, 30)] + ["[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    vocab += sorted(set(WORDS)) + list("abcdefghijklmnopqrstuvwxyz0123456789")
+    vocab += ["##" + c for c in "abcdefghijklmnopqrstuvwxyz0123456789"]
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, VOCAB_NAME), "w", encoding="utf-8") as writer:
+        writer.write("\n".join(vocab) + "\n")
+
+    torch.manual_seed(0)
+    config = BertConfig(len(vocab), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                        num_attention_heads=num_attention_heads, intermediate_size=intermediate_size)
+    model = BertForSequenceClassification(config, num_labels=len(label_list))
+    torch.save(model.state_dict(), os.path.join(model_dir, WEIGHTS_NAME))
+    with open(os.path.join(model_dir, CONFIG_NAME), "w", encoding="utf-8") as writer:
+        writer.write(config.to_json_string())
+    return model_dir
+
+
+def make_examples(count, seed=0):
+    """Candidate pairs over WORDS with a PERSON subject and an ORGANIZATION object."""
+    rng = random.Random(seed)
+    examples = []
+    for _ in range(count):
+        length = rng.randint(3, 40)
+        tokens = [rng.choice(WORDS) for _ in range(length)]
+        subj = rng.randint(0, length - 2)
+        obj = rng.randint(subj + 1, length - 1)
+        examples.append({"tokens": tokens, "subj": [tokens[subj], "PERSON", [subj, subj]],
+                         "obj": [tokens[obj], "ORGANIZATION", [obj, obj]]})
+    return examples
+
+
+@pytest.fixture(scope="session")
+def tiny_model_dir(tmp_path_factory):
+    return write_tiny_model(str(tmp_path_factory.mktemp("tiny_model")))
+
+
+@pytest.fixture
+def examples():
+    return make_examples(40)
+
+
+@pytest.fixture
+def examples_file(tmp_path, examples):
+    path = tmp_path / "examples.json"
+    path.write_text(json.dumps(examples), encoding="utf-8")
+    return str(path)
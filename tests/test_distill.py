@@ -0,0 +1,48 @@
+import os
+
+import pytest
+import torch
+
+import distill_span_pair
+import distill_student
+from pytorch_pretrained_bert.file_utils import CONFIG_NAME, WEIGHTS_NAME
+from pytorch_pretrained_bert.modeling import BertForSequenceClassification
+from pytorch_pretrained_bert.tokenization import VOCAB_NAME
+from spanbert import label_list
+
+
+def test_distill_span_pair_runs_to_the_end(tiny_model_dir, examples_file, tmp_path, capsys):
+    output_dir = str(tmp_path / "span_pair")
+    distill_span_pair.main(tiny_model_dir, examples_file, output_dir, epochs=1)
+
+    for name in (WEIGHTS_NAME, CONFIG_NAME, VOCAB_NAME):
+        assert os.path.exists(os.path.join(output_dir, name))
+    assert "Label agreement with SpanBERT" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("num_layers, hidden_size", [(1, None), (2, 40)])
+def test_distill_student_runs_to_the_end(tiny_model_dir, examples, tmp_path, monkeypatch, capsys,
+                                         num_layers, hidden_size):
+    # Candidate pairs come from spaCy; hand the script ready-made ones.
+    monkeypatch.setattr(distill_student, "candidate_pairs", lambda pages: list(examples))
+    output_dir = str(tmp_path / "student")
+    distill_student.main(tiny_model_dir, str(tmp_path), output_dir, num_layers, hidden_size, epochs=1)
+
+    for name in (WEIGHTS_NAME, CONFIG_NAME, VOCAB_NAME):
+        assert os.path.exists(os.path.join(output_dir, name))
+    assert "Label agreement" in capsys.readouterr().out
+
+
+def test_student_copies_the_teacher_layers_it_keeps(tiny_model_dir):
+    teacher = BertForSequenceClassification.from_pretrained(tiny_model_dir, num_labels=len(label_list))
+    student = distill_student.build_student(teacher, 1, teacher.config.hidden_size, len(label_list))
+    assert student.config.num_attention_heads == teacher.config.num_attention_heads
+    assert student.config.intermediate_size == teacher.config.intermediate_size
+    for name, tensor in student.bert.encoder.layer[0].state_dict().items():
+        assert torch.equal(tensor, teacher.bert.encoder.layer[0].state_dict()[name])
+
+
+def test_student_of_another_width_gets_a_valid_head_count(tiny_model_dir):
+    teacher = BertForSequenceClassification.from_pretrained(tiny_model_dir, num_labels=len(label_list))
+    student = distill_student.build_student(teacher, 2, 200, len(label_list))
+    assert 200 % student.config.num_attention_heads == 0
@@ -0,0 +1,68 @@
+import pytest
+import torch
+
+from pytorch_pretrained_bert.modeling import BertConfig, BertForSequenceClassification
+
+NUM_LAYERS = 4
+
+
+@pytest.fixture(scope="module")
+def model():
+    torch.manual_seed(0)
+    config = BertConfig(100, hidden_size=32, num_hidden_layers=NUM_LAYERS, num_attention_heads=4,
+                        intermediate_size=48)
+    model = BertForSequenceClassification(config, num_labels=5)
+    heads = model.add_exit_heads()
+    with torch.no_grad():
+        # Sharper heads, so confidences spread out and rows exit at different layers.
+        for head in heads:
+            head.weight.mul_(10)
+    return model.eval()
+
+
+@pytest.fixture(scope="module")
+def batch():
+    generator = torch.Generator().manual_seed(1)
+    lengths = torch.randint(2, 30, (48,), generator=generator)
+    input_mask = (torch.arange(30)[None, :] < lengths[:, None]).long()
+    input_ids = torch.randint(1, 100, (48, 30), generator=generator) * input_mask
+    return input_ids, torch.zeros_like(input_ids), input_mask
+
+
+def reference_early_exit(model, input_ids, segment_ids, input_mask, threshold):
+    """Runs every layer on the whole batch, then takes for every row the first confident head."""
+    with torch.no_grad():
+        encoded_layers, pooled_output = model.bert(input_ids, segment_ids, input_mask)
+        logits = model.classifier(pooled_output)
+        exit_logits = model.exit_head_logits(encoded_layers)
+    layers_run = torch.full((len(input_ids),), NUM_LAYERS, dtype=torch.long)
+    for row in range(len(input_ids)):
+        for i, head_logits in enumerate(exit_logits):
+            if torch.softmax(head_logits[row], dim=-1).max() >= threshold:
+                logits[row] = head_logits[row]
+                layers_run[row] = i + 1
+                break
+    return logits, layers_run
+
+
+@pytest.mark.parametrize("unpadded", [False, True])
+@pytest.mark.parametrize("threshold", [0.4, 0.6, 0.9, 1.01])
+def test_early_exit_matches_full_depth_reference(model, batch, unpadded, threshold):
+    model.bert.enable_unpadded(unpadded)
+    with torch.no_grad():
+        logits, layers_run = model.forward_early_exit(*batch, exit_threshold=threshold)
+    expected_logits, expected_layers = reference_early_exit(model, *batch, threshold)
+
+    assert torch.equal(layers_run, expected_layers)
+    torch.testing.assert_close(logits, expected_logits, rtol=1e-4, atol=1e-4)
+    if threshold > 1:
+        with torch.no_grad():
+            torch.testing.assert_close(logits, model(*batch), rtol=1e-5, atol=1e-5)
+
+
+def test_rows_exit_at_different_layers(model, batch):
+    model.bert.enable_unpadded(False)
+    with torch.no_grad():
+        _, layers_run = model.forward_early_exit(*batch, exit_threshold=0.6)
+    # Some rows leave after the first layer and others run them all, so the batch shrinks.
+    assert {1, NUM_LAYERS} <= set(layers_run.tolist())
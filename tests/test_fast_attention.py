@@ -0,0 +1,67 @@
+import os
+import shutil
+
+import pytest
+import torch
+
+from pytorch_pretrained_bert.file_utils import WEIGHTS_NAME
+from pytorch_pretrained_bert.mmap_weights import SAFE_WEIGHTS_NAME, convert_checkpoint
+from pytorch_pretrained_bert.modeling import BertForSequenceClassification, BertSelfAttention
+from spanbert import label_list
+
+
+def load(model_dir):
+    model = BertForSequenceClassification.from_pretrained(model_dir, num_labels=len(label_list))
+    return model.eval()
+
+
+def batch(vocab_size, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(1, vocab_size, (6, 24), generator=generator)
+    lengths = torch.tensor([24, 3, 17, 9, 1, 12])
+    input_mask = (torch.arange(24)[None, :] < lengths[:, None]).long()
+    return input_ids * input_mask, torch.zeros_like(input_ids), input_mask
+
+
+def logits(model, enabled, **kwargs):
+    model.enable_fast_attention(enabled)
+    with torch.no_grad():
+        return model(*batch(model.config.vocab_size), **kwargs)
+
+
+def attention_layers(model):
+    return [module for module in model.modules() if isinstance(module, BertSelfAttention)]
+
+
+@pytest.fixture
+def mapped_model_dir(tiny_model_dir, tmp_path):
+    model_dir = str(tmp_path / "mapped")
+    shutil.copytree(tiny_model_dir, model_dir)
+    convert_checkpoint(os.path.join(model_dir, WEIGHTS_NAME), os.path.join(model_dir, SAFE_WEIGHTS_NAME))
+    return model_dir
+
+
+def test_fast_attention_matches_eager_path(tiny_model_dir):
+    model = load(tiny_model_dir)
+    eager = logits(model, False)
+    fast = logits(model, True)
+    assert all(layer.qkv_weight is not None for layer in attention_layers(model))
+    torch.testing.assert_close(fast, eager, rtol=1e-5, atol=1e-5)
+
+
+def test_fast_attention_keeps_memory_mapped_weights_in_place(mapped_model_dir):
+    model = load(mapped_model_dir)
+    pointers = {name: p.data_ptr() for name, p in model.named_parameters()}
+    eager = logits(model, False)
+    fast = logits(model, True)
+
+    assert all(layer.qkv_weight is None for layer in attention_layers(model))
+    assert {name: p.data_ptr() for name, p in model.named_parameters()} == pointers
+    torch.testing.assert_close(fast, eager, rtol=1e-5, atol=1e-5)
+
+
+def test_moved_weights_are_packed_again(mapped_model_dir):
+    model = load(mapped_model_dir)
+    model.double()
+    model.enable_fast_attention(True)
+    assert all(layer.qkv_weight is not None for layer in attention_layers(model))
@@ -0,0 +1,80 @@
+import pytest
+
+from crawl_website import (_TEXT_EXTRACTORS, PageReader, _StdlibTextCounterParser, _VisibleTextCounter,
+                           _text_counter_parser, clean_html, decode_html, extract_text)
+
+# Pages every backend must turn into the same cleaned text as BeautifulSoup's html.parser.
+FIXTURES = {
+    "paragraphs": "<html><head><title>T</title></head><body><h1>Head</h1><p>One <b>two</b> three.</p></body></html>",
+    "script_style": "<p>a</p><script>var s = '</p>';</script><style>p { color: red }</style><p>b</p>",
+    "template": "<p>a</p><template><p>hidden</p></template><p>b</p>",
+    "noscript": "<noscript>Enable JavaScript</noscript><p>x</p>",
+    "comments": "<p>a<!-- hidden -->b</p><!-- trailing -->",
+    "entities": "<p>a&nbsp;b &amp; c &lt;d&gt; &#169; &copy;</p>",
+    "crlf": "<p>line one\r\nline two</p>\r\n<p>c\rd</p>",
+    "punctuation": "<p>Hello ,world ( a ) [ b ] !</p><ul><li>x</li><li> ; y</li></ul>",
+    "unclosed": "<p>a<div>b<span>c",
+    "doctype": "<!DOCTYPE html><html><body><p>a</p></body></html>",
+    "svg": "<svg><style>.a {}</style><text>t</text></svg><p>p</p>",
+    "pre": "<pre>  a\n    b  \n</pre>",
+    "table": "<table><tr><td>1</td><td>2</td></tr><tr><td>3</td></tr></table>",
+    "empty": "",
+    "whitespace": "   \n ",
+    "only_comment": "<!-- x -->",
+}
+
+
+def backend(name):
+    try:
+        clean_html("<p>x</p>", backend=name)
+    except ImportError:
+        pytest.skip(f"{name} is not installed")
+    return name
+
+
+@pytest.mark.parametrize("name", sorted(set(_TEXT_EXTRACTORS) - {"bs4"}))
+@pytest.mark.parametrize("fixture", sorted(FIXTURES))
+def test_backend_matches_bs4(name, fixture):
+    html = FIXTURES[fixture]
+    assert clean_html(html, backend=backend(name)) == clean_html(html, backend="bs4")
+
+
+def test_template_contents_are_skipped():
+    for name in _TEXT_EXTRACTORS:
+        try:
+            assert clean_html(FIXTURES["template"], backend=name) == "a b"
+        except ImportError:
+            pass
+
+
+def test_decode_html_uses_the_declared_charset():
+    html = "<meta charset='iso-8859-1'><p>café</p>"
+    assert decode_html(html.encode("iso-8859-1")) == html
+    assert decode_html("<p>café</p>".encode("cp1252"), "text/html; charset=windows-1252") == "<p>café</p>"
+    assert decode_html("<p>café</p>".encode("utf-8")) == "<p>café</p>"
+
+
+def visible_chars(parser_for, html):
+    counter = _VisibleTextCounter()
+    parser_for(counter).feed(html)
+    return counter.chars
+
+
+@pytest.mark.parametrize("parser_for", [_text_counter_parser, _StdlibTextCounterParser], ids=["default", "stdlib"])
+@pytest.mark.parametrize("fixture", ["paragraphs", "script_style", "template", "punctuation", "svg", "table"])
+def test_visible_text_counter_matches_the_extracted_text(parser_for, fixture):
+    html = FIXTURES[fixture]
+    # One separator per text node, where the extracted text has one between them.
+    assert visible_chars(parser_for, html) == len(extract_text(html, "bs4")) + 1
+
+
+def test_page_reader_stops_after_enough_text():
+    page = ("<html><body>" + "<script>" + "x" * 5000 + "</script>" +
+            "".join(f"<p>Paragraph {i} of the page.</p>" for i in range(1000)) + "</body></html>").encode()
+    reader = PageReader("text/html; charset=utf-8", text_chars=2000)
+    for start in range(0, len(page), 1024):
+        if reader.feed(page[start:start + 1024]):
+            break
+    html = reader.html()
+    assert reader.truncated and page.decode().startswith(html)
+    assert 2000 <= len(extract_text(html, "bs4")) < 2000 + 1024
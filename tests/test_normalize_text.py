@@ -0,0 +1,43 @@
+import random
+
+import pytest
+
+from crawl_website import NORMALIZE_SPECIAL_CHARS, _normalize_text_by_passes, normalize_text
+
+EDGE_CASES = [
+    "",
+    " ",
+    "\n\n\n",
+    "a\xa0b",
+    "\xa0\n\xa0 \xa0",
+    "word ,word ;word :word !word ?word .",
+    "end .  \n next",
+    "( a ) [ b ] ( ) [ ]",
+    "(\n a \n)",
+    "[ \t\n ]",
+    "a  ...  b ,,, c !? ;:",
+    "x ) ) ] . , y",
+    "( ( [ [ z",
+    "one\r\ntwo\r\n\r\nthree\rfour",
+    "  lead and trail  \n\t\n   \n last ",
+    "line\x0bwith\x0cform\x1cfeeds\x1d\x1e\x85  end",
+    "　( full width space )　",
+    "a\xa0,b \xa0. c",
+]
+
+
+@pytest.mark.parametrize("text", EDGE_CASES)
+def test_matches_reference_on_edge_cases(text):
+    assert normalize_text(text) == _normalize_text_by_passes(text)
+
+
+def test_matches_reference_on_random_text():
+    rng = random.Random(1234)
+    for _ in range(20000):
+        text = "".join(rng.choice(NORMALIZE_SPECIAL_CHARS) for _ in range(rng.randint(0, 24)))
+        assert normalize_text(text) == _normalize_text_by_passes(text), repr(text)
+
+
+def test_examples():
+    assert normalize_text("Hello , world ( yes ) !\n\n  [ ok ]  ") == "Hello, world (yes)!\n[ok]"
+    assert normalize_text("a\xa0b\r\n \r\nc") == "ab\nc"
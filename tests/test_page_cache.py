@@ -0,0 +1,144 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from crawl_website import UnsupportedContentError, read_html
+from page_cache import INDEX_NAME, PageCache
+
+
+class Site:
+    """A local HTTP server whose pages are set per path; records the headers of every request."""
+
+    def __init__(self):
+        self.pages = {}
+        self.requests = []
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                site.requests.append((self.path, dict(self.headers)))
+                page = site.pages.get(self.path)
+                if page is None:
+                    self.send_error(404)
+                    return
+                etag, last_modified = page.get("etag"), page.get("last_modified")
+                if (etag and self.headers.get("If-None-Match") == etag) or \
+                        (last_modified and self.headers.get("If-Modified-Since") == last_modified):
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                body = page["body"]
+                self.send_response(200)
+                self.send_header("Content-Type", page.get("content_type", "text/html; charset=utf-8"))
+                self.send_header("Content-Length", str(len(body)))
+                if etag:
+                    self.send_header("ETag", etag)
+                if last_modified:
+                    self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_port}{path}"
+
+    def hits(self, path):
+        return [headers for request_path, headers in self.requests if request_path == path]
+
+
+@pytest.fixture
+def site():
+    site = Site()
+    site.thread.start()
+    yield site
+    site.server.shutdown()
+    site.server.server_close()
+
+
+def page(text, **headers):
+    return dict(body=f"<html><body><p>{text}</p></body></html>".encode("utf-8"), **headers)
+
+
+def test_fresh_page_is_served_without_a_request(site, tmp_path):
+    site.pages["/a"] = page("first")
+    cache = PageCache(str(tmp_path), ttl=3600)
+    url = site.url("/a")
+
+    html, text = cache.fetch(url)
+    assert "first" in html and text is None
+    cache.store_text(url, html, "first")
+
+    assert cache.fetch(url) == (None, "first")
+    assert len(site.hits("/a")) == 1
+
+
+@pytest.mark.parametrize("validator, request_header", [
+    ({"etag": '"v1"'}, "If-None-Match"),
+    ({"last_modified": "Wed, 21 Oct 2015 07:28:00 GMT"}, "If-Modified-Since"),
+])
+def test_stale_page_is_revalidated(site, tmp_path, validator, request_header):
+    site.pages["/a"] = page("first", **validator)
+    cache = PageCache(str(tmp_path), ttl=0)
+    url = site.url("/a")
+    html, _ = cache.fetch(url)
+    cache.store_text(url, html, "first")
+
+    # Unchanged: the server answers 304 and the cached text is reused.
+    assert cache.fetch(url) == (None, "first")
+    second = site.hits("/a")[1]
+    assert second[request_header] == list(validator.values())[0]
+
+    # Changed: the new HTML comes back to be cleaned again.
+    site.pages["/a"] = page("second")
+    html, text = cache.fetch(url)
+    assert "second" in html and text is None
+
+
+def test_least_recently_used_pages_are_evicted(site, tmp_path):
+    # Random hex compresses to about 1700 bytes a page: the cap holds two of them.
+    bodies = {path: os.urandom(1500).hex().encode("ascii") for path in ("/a", "/b", "/c")}
+    for path, body in bodies.items():
+        site.pages[path] = {"body": body}
+    cache = PageCache(str(tmp_path), ttl=3600, max_bytes=4000)
+    cache.fetch(site.url("/a"))
+    cache.fetch(site.url("/b"))
+    # /a is now more recent than /b, also once the index is reloaded from disk.
+    cache.fetch(site.url("/a"))
+    cache.flush()
+
+    cache = PageCache(str(tmp_path), ttl=3600, max_bytes=4000)
+    cache.fetch(site.url("/c"))
+    assert cache.cached(site.url("/b")) is None
+    assert cache.cached(site.url("/a")) is not None
+    assert cache.cached(site.url("/c")) is not None
+    assert len(site.hits("/a")) == 1
+
+
+def test_index_is_written_on_flush(site, tmp_path):
+    site.pages["/a"] = page("first")
+    cache = PageCache(str(tmp_path), ttl=3600, save_interval=3600)
+    cache.fetch(site.url("/a"))
+    assert not (tmp_path / INDEX_NAME).exists()
+
+    cache.flush()
+    assert PageCache(str(tmp_path), ttl=3600).cached(site.url("/a")) is not None
+
+
+@pytest.mark.parametrize("body, content_type", [
+    (b"%PDF-1.4 binary", "application/pdf"),
+    (b"%PDF-1.4 binary", "text/html"),
+])
+def test_non_html_pages_are_rejected(site, tmp_path, body, content_type):
+    site.pages["/doc"] = {"body": body, "content_type": content_type}
+    cache = PageCache(str(tmp_path), read=read_html)
+
+    with pytest.raises(UnsupportedContentError):
+        cache.fetch(site.url("/doc"))
+    assert cache.cached(site.url("/doc")) is None
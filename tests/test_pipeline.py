@@ -0,0 +1,48 @@
+import sys
+import time
+
+import pytest
+
+from pipeline import Pipeline, Stage
+
+
+def test_item_errors_skip_the_item():
+    def parse(x):
+        if x == 3:
+            raise ValueError("unparsable page")
+        return x
+
+    pipeline = Pipeline([Stage("parse", parse, workers=2, item_errors=(ValueError,))])
+    assert sorted(pipeline.run(range(6))) == [0, 1, 2, 4, 5]
+
+
+def test_persistent_errors_stop_the_pipeline():
+    def classify(x):
+        raise RuntimeError("model failed to load")
+
+    pipeline = Pipeline([Stage("classify", classify, workers=2)])
+    with pytest.raises(RuntimeError, match="model failed to load"):
+        list(pipeline.run(range(20)))
+
+
+def test_output_of_parallel_items_does_not_interleave(capsys):
+    def report(x):
+        print(f"item {x}:", end=" ")
+        time.sleep(0.01)
+        print("first line")
+        print(f"item {x}: second line")
+        return x
+
+    pipeline = Pipeline([Stage("report", report, workers=4)])
+    for x in pipeline.run(range(8)):
+        print(f"done {x}")
+    # The real stdout is back once the pipeline is done.
+    assert "PipelineOutput" not in type(sys.stdout).__name__
+
+    lines = capsys.readouterr().out.splitlines()
+    assert sorted(lines) == sorted([f"item {x}: first line" for x in range(8)] +
+                                   [f"item {x}: second line" for x in range(8)] +
+                                   [f"done {x}" for x in range(8)])
+    for x in range(8):
+        first = lines.index(f"item {x}: first line")
+        assert lines[first + 1] == f"item {x}: second line"
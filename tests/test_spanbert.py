@@ -0,0 +1,32 @@
+import numpy as np
+import pytest
+
+from conftest import make_examples
+from spanbert import SpanBERT
+
+
+@pytest.fixture(scope="module")
+def reference(tiny_model_dir):
+    """Logits of the padded, exact-attention path, and the examples they are for."""
+    examples = make_examples(60, seed=3)
+    bert = SpanBERT(tiny_model_dir, fast_attention=False, unpadded=False)
+    return examples, bert.predict_logits(examples)
+
+
+@pytest.mark.parametrize("fast_attention", [False, True])
+def test_unpadded_matches_padded(tiny_model_dir, reference, fast_attention):
+    examples, logits = reference
+    bert = SpanBERT(tiny_model_dir, fast_attention=fast_attention, unpadded=True)
+    assert bert.classifier.bert.unpadded
+    np.testing.assert_allclose(bert.predict_logits(examples), logits, rtol=1e-4, atol=1e-5)
+
+
+def test_packing_matches_padded(tiny_model_dir, reference):
+    examples, logits = reference
+    bert = SpanBERT(tiny_model_dir, packing=True)
+    batches, _ = bert._build_batches(examples)
+    # Several examples share a row, each read out at its own [CLS] position.
+    assert sum(len(batch[0]) for batch in batches) < len(examples)
+    np.testing.assert_allclose(bert.predict_logits(examples), logits, rtol=1e-4, atol=1e-5)
+    assert [label for label, _ in bert.predict(examples)] == \
+        [label for label, _ in SpanBERT(tiny_model_dir).predict(examples)]
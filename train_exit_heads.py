@@ -0,0 +1,112 @@
+"""
+Trains the early-exit heads of the SpanBERT classifier: one linear classifier over the [CLS]
+hidden state of every encoder layer but the last, trained with BertAdam to match the softened
+predictions of the final classifier. The encoder stays frozen, so the hidden states are
+computed once. The heads are saved next to the model weights, where
+`SpanBERT(..., early_exit_threshold=...)` picks them up, and the label agreement, average
+number of layers and time at several thresholds are reported at the end.
+
+Usage: python3 train_exit_heads.py <pretrained dir> <examples.json> [epochs]
+where examples.json holds a list of {"tokens": [...], "subj": [...], "obj": [...]} pairs,
+e.g. the one written by distill_student.py.
+"""
+import json
+import os
+import random
+import sys
+import time
+
+import torch
+
+from pytorch_pretrained_bert.optimization import BertAdam
+from spanbert import EXIT_HEADS_NAME, SpanBERT, compare_predictions, distillation_loss
+
+BATCH_SIZE = 64
+LEARNING_RATE = 1e-3
+TEMPERATURE = 2.0
+THRESHOLDS = [0.99, 0.95, 0.9, 0.8]
+
+
+def collect_hidden_states(bert, examples):
+    """The [CLS] hidden state of every layer but the last, [num_layers - 1, len(examples), hidden],
+    and the final logits of every example, both in example order and float32 on the CPU."""
+    classifier = bert.classifier
+    hidden_states = None
+    logits = torch.empty(len(examples), bert.num_labels)
+    offset = 0
+    classifier.eval()
+    with bert._buffers_lock:
+        batches, order = bert._build_batches(examples)
+        for input_ids, input_mask, segment_ids in batches:
+            input_ids, input_mask, segment_ids = (t.to(bert.device) for t in (input_ids, input_mask, segment_ids))
+            with torch.no_grad():
+                encoded_layers, pooled_output = classifier.bert(input_ids, segment_ids, input_mask)
+                batch_logits = classifier.classifier(pooled_output)
+            cls_states = torch.stack([layer[:, 0] for layer in encoded_layers[:-1]]).float().cpu()
+            if hidden_states is None:
+                hidden_states = torch.empty(cls_states.size(0), len(examples), cls_states.size(2))
+            indices = torch.from_numpy(order[offset:offset + len(input_ids)])
+            hidden_states[:, indices] = cls_states
+            logits[indices] = batch_logits.float().cpu()
+            offset += len(input_ids)
+    return hidden_states, logits
+
+
+def train(exit_heads, hidden_states, targets, epochs):
+    num_batches = (targets.size(0) + BATCH_SIZE - 1) // BATCH_SIZE
+    optimizer = BertAdam(exit_heads.parameters(), lr=LEARNING_RATE, warmup=0.1, t_total=num_batches * epochs)
+    for epoch in range(epochs):
+        exit_heads.train()
+        order = list(range(targets.size(0)))
+        random.Random(epoch).shuffle(order)
+        total_loss = 0.0
+        for start in range(0, len(order), BATCH_SIZE):
+            batch = torch.tensor(order[start:start + BATCH_SIZE])
+            # Every head learns from the final classifier on the same rows.
+            loss = sum(distillation_loss(head(hidden_states[i, batch]), targets[batch], TEMPERATURE)
+                       for i, head in enumerate(exit_heads))
+            loss.backward()
+            optimizer.step()
+            optimizer.zero_grad()
+            total_loss += loss.item() / len(exit_heads)
+        print(f"Epoch {epoch + 1}/{epochs}: loss {total_loss / max(num_batches, 1):.4f}")
+    exit_heads.eval()
+
+
+def main(pretrained_dir, examples_file, epochs=5):
+    with open(examples_file, "r", encoding="utf-8") as reader:
+        examples = json.load(reader)
+
+    bert = SpanBERT(pretrained_dir)
+    if bert.classifier.bert.unpadded:
+        # Every layer's output is needed, not only the [CLS] rows of the last one.
+        bert.classifier.bert.enable_unpadded(False)
+    print(f"Computing the hidden states of {len(examples)} candidate pairs ...")
+    hidden_states, targets = collect_hidden_states(bert, examples)
+
+    exit_heads = bert.classifier.add_exit_heads().float().cpu()
+    train(exit_heads, hidden_states, targets, epochs)
+    torch.save(exit_heads.state_dict(), os.path.join(pretrained_dir, EXIT_HEADS_NAME))
+    print(f"Saved {len(exit_heads)} exit heads to {pretrained_dir}")
+    del bert
+
+    bert = SpanBERT(pretrained_dir)
+    start = time.perf_counter()
+    reference = bert.predict(examples)
+    reference_time = time.perf_counter() - start
+    num_layers = bert.classifier.config.num_hidden_layers
+    print("threshold  layers  agreement  time")
+    print(f"     none  {num_layers:6.2f}     1.0000  {reference_time:.2f}s")
+    for threshold in THRESHOLDS:
+        start = time.perf_counter()
+        preds = bert.predict(examples, exit_threshold=threshold)
+        elapsed = time.perf_counter() - start
+        report = compare_predictions(reference, preds)
+        print(f"{threshold:9.2f}  {bert.average_layers:6.2f}     {report['label_agreement']:.4f}  {elapsed:.2f}s")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 4):
+        print("Usage: python3 train_exit_heads.py <pretrained dir> <examples.json> [epochs]")
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2], int(sys.argv[3]) if len(sys.argv) == 4 else 5)